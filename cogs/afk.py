@@ -1,9 +1,10 @@
-import contextlib
+import array
+import asyncio
 import discord
 import enum
 
-from collections import defaultdict, deque
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timezone
 from discord.ext import commands
 
 from .utils import time
@@ -14,6 +15,96 @@ from .utils.jsonf import JSONFile
 class AFKConfig(enum.IntEnum):
     MAX_MESSAGES = 5
     MAX_INTERVAL = 10 * 60
+    # How long to wait before saying the same AFK message in the same channel.
+    REPLY_COOLDOWN = 15
+
+
+class _ActivityTracker:
+    """Keeps track of the last few times each user said something.
+
+    Every user gets a ring of the last ``size`` timestamps, all of which are
+    stored in one big array of doubles, so there's no object per message
+    (or even per user). Users who haven't said anything in ``window``
+    seconds are forgotten, and their ring is handed to the next new user.
+    """
+
+    def __init__(self, size, window):
+        if not 0 < size < 256:
+            raise ValueError('size must be between 1 and 255')
+
+        self.size = size
+        self.window = window
+        self._times = array.array('d')
+        # Where the next timestamp goes in each ring, and how many it has.
+        self._heads = array.array('B')
+        self._counts = array.array('B')
+        # user ID -> ring, from least to most recently active.
+        self._rings = OrderedDict()
+        self._free = []
+
+    def __len__(self):
+        return len(self._rings)
+
+    def __contains__(self, user_id):
+        return user_id in self._rings
+
+    def _new_ring(self):
+        if self._free:
+            ring = self._free.pop()
+            self._heads[ring] = self._counts[ring] = 0
+            return ring
+
+        ring = len(self._heads)
+        self._times.extend(0.0 for _ in range(self.size))
+        self._heads.append(0)
+        self._counts.append(0)
+        return ring
+
+    def _latest(self, ring):
+        return self._times[ring * self.size + (self._heads[ring] - 1) % self.size]
+
+    def _expire(self, now):
+        rings = self._rings
+        while rings:
+            user_id, ring = next(iter(rings.items()))
+            if now - self._latest(ring) <= self.window:
+                break
+            rings.popitem(last=False)
+            self._free.append(ring)
+
+    def add(self, user_id, when):
+        """Records that the user said something at the given time, in seconds.
+
+        Returns True if they've now said ``size`` things in ``window`` seconds.
+        """
+        ring = self._rings.get(user_id)
+        if ring is None:
+            ring = self._rings[user_id] = self._new_ring()
+        else:
+            self._rings.move_to_end(user_id)
+
+        size = self.size
+        head = self._heads[ring]
+        self._times[ring * size + head] = when
+        self._heads[ring] = head = (head + 1) % size
+        if self._counts[ring] < size:
+            self._counts[ring] += 1
+
+        self._expire(when)
+
+        # Now that the ring's full, the head is the oldest one.
+        return (self._counts[ring] == size
+                and when - self._times[ring * size + head] <= self.window)
+
+    def discard(self, user_id):
+        ring = self._rings.pop(user_id, None)
+        if ring is not None:
+            self._free.append(ring)
+
+
+def _timestamp(dt):
+    # created_at is naive, but it's in UTC.
+    return dt.replace(tzinfo=timezone.utc).timestamp()
 
 
 class AFK:
@@ -21,39 +112,100 @@ class AFK:
         self.bot = bot
         # Debating whether or not I should use a DB. Because this would be queried
         # for EVERY message, making it extremely intense.
-        self.afks = JSONFile("afk.json")
-        self.afk_configs = JSONFile('afkconfig.json')
-        self.user_message_queues = defaultdict(deque)
+        self.afks = JSONFile("afk.json", engine='journal', key_type=int)
+        self.afk_configs = JSONFile('afkconfig.json', key_type=int)
+        self._activity = _ActivityTracker(AFKConfig.MAX_MESSAGES, AFKConfig.MAX_INTERVAL)
+        # user ID -> when they last said something, for the embeds.
+        self._last_seen = {}
+
+        # Getting the colour of someone's avatar is slow, so the embeds are
+        # made ahead of time, and the colour is filled in when it's ready.
+        # user ID -> embed
+        self._embeds = {}
+        # user ID -> (avatar, colour)
+        self._colours = {}
+        self._colour_tasks = {}
+        # (channel ID, user ID) -> when their AFK message was last said there
+        self._last_replies = {}
 
-    async def _get_afk_embed(self, member):
+    def __unload(self):
+        for task in self._colour_tasks.values():
+            task.cancel()
+
+    async def _resolve_colour(self, member):
+        avatar = member.avatar
+        try:
+            colour = await user_color(member)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Not worth trying again and again, the role colour will do.
+            colour = member.colour
+        finally:
+            self._colour_tasks.pop(member.id, None)
+
+        self._colours[member.id] = avatar, colour
+        embed = self._embeds.get(member.id)
+        if embed is not None:
+            embed.colour = colour
+
+    def _refresh_colour(self, member):
+        if member.id not in self._colour_tasks:
+            self._colour_tasks[member.id] = self.bot.loop.create_task(self._resolve_colour(member))
+
+    def _get_afk_embed(self, member):
         message = self.afks.get(member.id)
         if message is None:
             return None
 
-        avatar = member.avatar_url
-        colour = await user_color(member)
-        title = f"{member.display_name} is AFK"
+        cached = self._colours.get(member.id)
+        if cached is None or cached[0] != member.avatar:
+            # New avatar, new colour. The old one can be used until then.
+            self._refresh_colour(member)
 
-        embed = (discord.Embed(description=message, colour=colour)
-                .set_author(name=title, icon_url=avatar)
+        title = f"{member.display_name} is AFK"
+        embed = self._embeds.get(member.id)
+        # The title has to be changed for servers they have a nickname in.
+        if embed is None or embed.author.name != title:
+            colour = cached[1] if cached else member.colour
+            embed = self._embeds[member.id] = (
+                discord.Embed(description=message, colour=colour)
+                .set_author(name=title, icon_url=member.avatar_url)
                 .set_footer(text=f"ID: {member.id}")
-                )
+            )
 
-        with contextlib.suppress(IndexError):
-            embed.timestamp = self.user_message_queues[member.id][-1]
+        last_seen = self._last_seen.get(member.id)
+        if last_seen is not None:
+            embed.timestamp = datetime.utcfromtimestamp(last_seen)
         return embed
 
-    def _has_messaged_too_much(self, author):
-        message_queue = self.user_message_queues[author.id]
-        if len(message_queue) <= AFKConfig.MAX_MESSAGES:
+    def _should_reply(self, channel, member):
+        now = self.bot.loop.time()
+        key = channel.id, member.id
+        last = self._last_replies.get(key)
+        if last is not None and now - last < AFKConfig.REPLY_COOLDOWN:
             return False
 
-        delta = (message_queue.popleft() - datetime.now()).total_seconds()
-        return delta >= AFKConfig.MAX_INTERVAL
+        self._last_replies[key] = now
+        if len(self._last_replies) > 1024:
+            self._last_replies = {
+                k: t for k, t in self._last_replies.items()
+                if now - t < AFKConfig.REPLY_COOLDOWN
+            }
+        return True
+
+    def _forget_embed(self, user_id):
+        self._embeds.pop(user_id, None)
+        self._colours.pop(user_id, None)
+        task = self._colour_tasks.pop(user_id, None)
+        if task is not None:
+            task.cancel()
 
     async def _remove_afk(self, author):
         await self.afks.remove(author.id)
-        self.user_message_queues.pop(author.id, None)
+        self._activity.discard(author.id)
+        self._last_seen.pop(author.id, None)
+        self._forget_embed(author.id)
 
     def _afk_messages_enabled(self, server):
         if server.id not in self.afk_configs:
@@ -73,6 +225,8 @@ class AFK:
             await ctx.send("You are no longer AFK")
         else:
             await self.afks.put(member.id, message)
+            self._embeds.pop(member.id, None)
+            self._get_afk_embed(member)
             await ctx.send("You are AFK")
 
     @commands.command(name='afksay')
@@ -99,8 +253,8 @@ class AFK:
         if author.id not in self.afks:
             return
 
-        self.user_message_queues[author.id].append(message.created_at)
-        if self._has_messaged_too_much(author):
+        when = self._last_seen[author.id] = _timestamp(message.created_at)
+        if self._activity.add(author.id, when):
             await self._remove_afk(author)
             await message.channel.send(f"{author.mention}, you are no longer AFK as you have messaged "
                                        f"{AFKConfig.MAX_MESSAGES} times in less than "
@@ -114,8 +268,8 @@ class AFK:
             return
 
         for user in message.mentions:
-            afk_embed = await self._get_afk_embed(user)
-            if afk_embed:
+            afk_embed = self._get_afk_embed(user)
+            if afk_embed and self._should_reply(message.channel, user):
                 await message.channel.send(embed=afk_embed)
 
     async def on_message(self, message):
@@ -1,14 +1,18 @@
+import asyncio
 import asyncpg
 import asyncqlio
 import datetime
 import discord
+import logging
 
 from discord.ext import commands
 
 from .utils import disambiguate
-from .utils.misc import emoji_url, truncate
+from .utils.misc import emoji_url, retry_forever, truncate
 
 
+log = logging.getLogger(__name__)
+
 _Table = asyncqlio.table_base()
 _blocked_icon = emoji_url('\N{NO ENTRY}')
 _unblocked_icon = emoji_url('\N{WHITE HEAVY CHECK MARK}')
@@ -40,35 +44,108 @@ class Blacklist(_Table):
 _GuildOrUser = disambiguate.union(discord.Guild, discord.User)
 
 
+_NOTIFY_CHANNEL = 'blacklist_changed'
+
+
 class Blacklists:
+    # Set this to True if multiple processes share the same database.
+    # Each process will then reload its blacklist whenever another one
+    # modifies it, through Postgres' LISTEN/NOTIFY.
+    sync_with_other_processes = False
+
     def __init__(self, bot):
         self.bot = bot
         self._md = self.bot.db.bind_tables(_Table)
+
+        # The blacklist is tiny, and only ever changes through the commands
+        # below, so it's kept entirely in memory. snowflake -> reason
+        self._blacklist = {}
+        self._blacklist_ready = asyncio.Event()
+        self._listener_conn = None
+
         # Unlike other cogs, this has to be created always. See below.
         self.bot.loop.create_task(self._create_permissions())
+        # Blacklisted users should always be told that they're blacklisted,
+        # rather than whatever else would've stopped them.
+        self.bot.add_command_gate(self._check_blacklist, priority=-1)
+
+    def __unload(self):
+        self.bot.remove_command_gate(self._check_blacklist)
+        if self._listener_conn is not None:
+            self.bot.loop.create_task(self._stop_listening())
 
     # This function is here because if we don't create the table,
     # the global check will just error out, and prevent any commands
     # from being run.
     async def _create_permissions(self):
-        async with self.bot.db.get_ddl_session() as session:
-            for name, table in self._md.tables.items():
-                await session.create_table(name, *table.columns)
+        try:
+            async with self.bot.db.get_ddl_session() as session:
+                for name, table in self._md.tables.items():
+                    await session.create_table(name, *table.columns)
+        except Exception:
+            log.exception('Creating the blacklist table failed.')
+
+        # Until this is done, the blacklist is checked in the DB like before.
+        await retry_forever(self._load_blacklist, log=log, what='Loading the blacklist')
+        self._blacklist_ready.set()
+
+        if self.sync_with_other_processes:
+            await self._start_listening()
+
+    async def _load_blacklist(self):
+        async with self.bot.db.get_session() as session:
+            blacklist = {row.snowflake: row.reason
+                         async for row in await session.select.from_(Blacklist).all()}
+
+        self._blacklist = blacklist
+
+    # LISTEN only takes effect once the transaction is committed, so we
+    # need a connection that lives outside of any session.
+    async def _start_listening(self):
+        try:
+            self._listener_conn = await self.bot.db.connector.pool.acquire()
+            await self._listener_conn.add_listener(_NOTIFY_CHANNEL, self._on_notify)
+        except Exception as e:
+            log.error('Could not listen for blacklist changes: %r', e)
+            self._listener_conn = None
+
+    async def _stop_listening(self):
+        conn, self._listener_conn = self._listener_conn, None
+        await conn.remove_listener(_NOTIFY_CHANNEL, self._on_notify)
+        await self.bot.db.connector.pool.release(conn)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self.bot.loop.create_task(self._load_blacklist())
+
+    async def _notify_change(self, session):
+        if self.sync_with_other_processes:
+            await session.execute(f"NOTIFY {_NOTIFY_CHANNEL};")
 
     async def __local_check(self, ctx):
         return await ctx.bot.is_owner(ctx.author)
 
-    async def __global_check_once(self, ctx):
-        async def get_blacklist(id):
-            return await ctx.session.select.from_(Blacklist).where(Blacklist.snowflake == id).first()
+    async def _get_blacklist(self, ctx, ids):
+        if self._blacklist_ready.is_set():
+            return self._blacklist
+
+        query = ctx.session.select.from_(Blacklist).where(Blacklist.snowflake.in_(*ids))
+        return {row.snowflake: row.reason async for row in await query.all()}
+
+    async def _check_blacklist(self, ctx):
+        ids = [ctx.author.id]
+        if ctx.guild is not None:
+            ids.append(ctx.guild.id)
 
-        row = await get_blacklist(ctx.author.id)
-        if row:
-            raise Blacklisted('You have been blacklisted by the owner.', row.reason)
+        blacklist = await self._get_blacklist(ctx, ids)
+        if not blacklist:
+            return True
 
-        row = await get_blacklist(ctx.guild.id)
-        if row:
-            raise Blacklisted('This server has been blacklisted by the owner.', row.reason)
+        # The reason can be NULL, so check the IDs themselves.
+        if ctx.author.id in blacklist:
+            raise Blacklisted('You have been blacklisted by the owner.', blacklist[ctx.author.id])
+
+        if ctx.guild is not None and ctx.guild.id in blacklist:
+            raise Blacklisted('This server has been blacklisted by the owner.', blacklist[ctx.guild.id])
 
         return True
 
@@ -109,9 +186,11 @@ class Blacklists:
         try:
             async with ctx.db.get_session() as session:
                 await session.add(row)
+                await self._notify_change(session)
         except asyncpg.UniqueViolationError:
             return await ctx.send(f'{server_or_user} has already been blacklisted.')
         else:
+            self._blacklist[server_or_user.id] = reason
             await self._show_blacklist_embed(ctx, 0xd50000, 'blacklisted', _blocked_icon,
                                              server_or_user, reason, time)
 
@@ -130,8 +209,12 @@ class Blacklists:
                 return await ctx.send(f"{server_or_user} isn't blacklisted.")
 
             await session.remove(row)
-            await self._show_blacklist_embed(ctx, 0x4CAF50, 'unblacklisted', _unblocked_icon,
-                                             server_or_user, reason, datetime.datetime.utcnow())
+            await self._notify_change(session)
+
+        # Only once it's really gone from the DB.
+        self._blacklist.pop(server_or_user.id, None)
+        await self._show_blacklist_embed(ctx, 0x4CAF50, 'unblacklisted', _unblocked_icon,
+                                         server_or_user, reason, datetime.datetime.utcnow())
 
 
 
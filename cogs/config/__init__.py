@@ -10,8 +10,8 @@ class Config(Prefixes, Permissions, WelcomeMessages):
     async def __global_check(self, ctx):
         return await self._Permissions__global_check(ctx)
 
-    async def __global_check_once(self, ctx):
-        return await self._Permissions__global_check_once(ctx)
+    def __unload(self):
+        self._Permissions__unload()
 
 def setup(bot):
     bot.add_cog(Config(bot))
@@ -1,24 +1,34 @@
+import asyncio
 import asyncpg
 import asyncqlio
 import discord
 import functools
 import itertools
+import logging
 import operator
+import sys
 
-from collections import defaultdict, namedtuple
+from collections import Counter, defaultdict, namedtuple
 from discord.ext import commands
 from more_itertools import iterate, one, partition
 
 from ._initroot import InitRoot
 
 from ..utils import cache, formats, disambiguate
+from ..utils.formats import pluralize
 from ..utils.converter import BotCommand, BotCogConverter
-from ..utils.misc import emoji_url, truncate, unique
+from ..utils.misc import emoji_url, retry_forever, truncate, unique
 from ..utils.paginator import ListPaginator
 
+log = logging.getLogger(__name__)
+
 
 ALL_MODULES_KEY = '*'
 
+# The maximum number of guilds whose permissions are kept in memory.
+# The least recently used guilds get thrown out once this is exceeded.
+PERMISSIONS_CACHE_SIZE = 2048
+
 
 class _PermissionFormattingMixin:
     def _get_header(self):
@@ -77,6 +87,28 @@ def _walk_parents(command):
     return iter(iterate(operator.attrgetter('parent'), command).__next__, None)
 
 
+def _command_names(command):
+    """Returns every node a permission can be set on for a command, most specific first."""
+    return [*map(_command_node, _walk_parents(command)), command.cog_name, ALL_MODULES_KEY]
+
+
+def _first_override(lookup, objects, names):
+    """Returns the first override that applies to the given objects and names,
+    as (typename, object, name, whitelist). Returns None if nothing applies.
+    """
+    for typename, obj in objects:
+        overrides = lookup.get(obj.id)
+        if not overrides:  # more likely for an id to not be in here.
+            continue
+
+        for name in names:
+            whitelist = overrides.get(name)
+            if whitelist is not None:
+                return typename, obj, name, whitelist
+
+    return None
+
+
 _Table = asyncqlio.table_base()
 
 
@@ -195,30 +227,88 @@ class Permissions(InitRoot):
     def __init__(self, bot):
         super().__init__(bot)
         self._md = self.bot.db.bind_tables(_Table)
+
+        # Ignores barely ever change, so there's no point in querying the
+        # DB for them on every single command. guild_id -> {entity_id, ...}
+        self._plonks = {}
+        self._plonks_ready = asyncio.Event()
+        self._plonk_stats = Counter()
+
         # Unlike other cogs, this has to be created always. See below.
         self.bot.loop.create_task(self._create_permissions())
+        self.bot.add_command_gate(self._command_gate)
+
+    def __unload(self):
+        self.bot.remove_command_gate(self._command_gate)
 
     # This function is here because if we don't create the table,
     # the global check will just error out, and prevent any commands
     # from being run.
     async def _create_permissions(self):
-        async with self.bot.db.get_ddl_session() as session:
-            for name, table in self._md.tables.items():
-                await session.create_table(name, *table.columns)
+        try:
+            async with self.bot.db.get_ddl_session() as session:
+                for name, table in self._md.tables.items():
+                    await session.create_table(name, *table.columns)
+        except Exception:
+            # The tables most likely exist already, so the ignores can still
+            # be loaded. If they don't, loading them will keep failing anyway.
+            log.exception('Creating the permissions tables failed.')
+
+        # Until this is done, ignores are checked in the DB like before.
+        await retry_forever(self._load_plonks, log=log, what='Loading the ignores')
+        self._plonks_ready.set()
+
+    async def _load_plonks(self):
+        async with self.bot.db.get_session() as session:
+            async for row in await session.select.from_(Plonks).all():
+                self._plonks.setdefault(row.guild_id, set()).add(row.entity_id)
+
+    async def _get_plonks(self, session, guild_id, *entity_ids):
+        """Returns which of the given IDs are ignored in the guild."""
+        if self._plonks_ready.is_set():
+            plonks = self._plonks.get(guild_id, ())
+            return [id for id in entity_ids if id in plonks] if entity_ids else list(plonks)
+
+        condition = Plonks.guild_id == guild_id
+        if entity_ids:
+            condition &= Plonks.entity_id.in_(*entity_ids)
+        query = session.select.from_(Plonks).where(condition)
+        return [row.entity_id async for row in await query.all()]
+
+    def _add_plonks(self, guild_id, ids):
+        self._plonks.setdefault(guild_id, set()).update(ids)
+
+    def _remove_plonks(self, guild_id, ids):
+        plonks = self._plonks.get(guild_id)
+        if plonks is None:
+            return
 
-    async def __global_check_once(self, ctx):
+        plonks.difference_update(ids)
+        if not plonks:
+            del self._plonks[guild_id]
+
+    def _plonks_size(self):
+        """Returns the approximate number of bytes taken up by the ignore index."""
+        return sys.getsizeof(self._plonks) + sum(map(sys.getsizeof, self._plonks.values()))
+
+    async def _command_gate(self, ctx):
+        # Ignores and permissions are resolved here in one go, so that
+        # a command costs at most one query (when the permissions for the
+        # guild aren't cached yet), and none at all otherwise.
         if not ctx.guild:
             return True
 
-        if await ctx.bot.is_owner(ctx.author):
-            return True
+        if await self._get_plonks(ctx.session, ctx.guild.id, ctx.channel.id, ctx.author.id):
+            self._plonk_stats['hits'] += 1
+            return False
 
-        query = (ctx.session.select.from_(Plonks)
-                            .where((Plonks.guild_id == ctx.guild.id)
-                                   & Plonks.entity_id.in_(ctx.channel.id, ctx.author.id))
-                )
-        row = await query.first()
-        return row is None
+        self._plonk_stats['misses'] += 1
+
+        lookup = await self._get_permissions(ctx.session, ctx.guild.id)
+        self._resolve_permissions(ctx, lookup)
+        # Let __global_check know it doesn't have to do this all over again.
+        ctx._resolved_permissions_for = ctx.command
+        return True
 
     async def on_command_error(self, ctx, error):
         if isinstance(error, (PermissionDenied, InvalidPermission)):
@@ -294,7 +384,7 @@ class Permissions(InitRoot):
 
         columns = ('guild_id', 'snowflake', 'name', 'whitelist')
         to_insert = [(guild_id, id, name, whitelist) for id in ids]
-        conn = session.transaction.acquired_connection
+        conn = await session.connection()
 
         await conn.copy_records_to_table('permissions', columns=columns, records=to_insert)
 
@@ -305,15 +395,23 @@ class Permissions(InitRoot):
         method = self._set_one_permission if len(entities) == 1 else self._bulk_set_permissions
         await method(session, guild_id, name, *entities, whitelist=whitelist)
 
-    @cache.cache(maxsize=None, make_key=lambda a, kw: a[-1])
+    @cache.cache(maxsize=PERMISSIONS_CACHE_SIZE, make_key=lambda a, kw: a[-1], coalesce=False)
     async def _get_permissions(self, session, guild_id):
         query = (session.select.from_(CommandPermissions)
                         .where(CommandPermissions.guild_id == guild_id)
                  )
 
-        lookup = defaultdict(lambda: (set(), set()))
-        async for row in await query.all():
-            lookup[row.snowflake][row.whitelist].add(row.name)
+        # snowflake -> {node: whitelist}
+        #
+        # Only entities that actually have an override end up in here, so
+        # resolving a command only has to look at those. Denies go in first
+        # so that an allow for the same node overrides it.
+        rows = sorted([r async for r in await query.all()], key=operator.attrgetter('whitelist'))
+        lookup = defaultdict(dict)
+        for row in rows:
+            # Interning the names means every guild shares the same strings
+            # for the same command nodes.
+            lookup[row.snowflake][sys.intern(row.name)] = row.whitelist
 
         # Converting this to a dict so future retrievals of this via cache
         # don't accidentally modify this.
@@ -323,6 +421,10 @@ class Permissions(InitRoot):
         if not ctx.guild:  # Custom permissions don't really apply in DMs
             return True
 
+        if getattr(ctx, '_resolved_permissions_for', None) is ctx.command:
+            # Already resolved by the command gate.
+            return True
+
         # This check has to be here. Because if we used ctx.reinvoke
         # in the global on_command_error, the command will fail because
         # of a race. Since on_command_error is dispatched rather than
@@ -334,23 +436,26 @@ class Permissions(InitRoot):
 
         # XXX: Should I have a check for if the table/relation actually exists?
         lookup = await self._get_permissions(ctx.session, ctx.guild.id)
+        return self._resolve_permissions(ctx, lookup)
+
+    def _resolve_permissions(self, ctx, lookup):
         if not lookup:
             # "Fast" path
             return True
 
         dummy_server = Server(ctx.guild)
 
+        # Only the roles that have overrides need to be sorted, which is
+        # usually a tiny fraction of the member's roles.
+        roles = sorted((r for r in ctx.author.roles if r.id in lookup), reverse=True)
         objects = itertools.chain(
             [('user', ctx.author)],
-            zip(itertools.repeat('role'), sorted(ctx.author.roles, reverse=True)),
+            zip(itertools.repeat('role'), roles),
             [('channel', ctx.channel),
              ('server', dummy_server)],
         )
 
-        names = itertools.chain(
-            map(_command_node, _walk_parents(ctx.command)),
-            (ctx.command.cog_name, ALL_MODULES_KEY)
-        )
+        names = _command_names(ctx.command)
 
         # The following code is roughly along the lines of this:
         # Apply guild-level denies first
@@ -377,17 +482,14 @@ class Permissions(InitRoot):
         #    know the last perm that will be applied, but here we'll able to know
         #    because we're looking for the first perm.
         #
-        for (typename, obj), name in itertools.product(objects, names):
-            if obj.id not in lookup:  # more likely for an id to not be in here.
-                continue
-
-            if name in lookup[obj.id][True]:  # allow overrides deny
-                return True
-
-            elif name in lookup[obj.id][False]:
-                raise PermissionDenied(f'{name} is denied on the {typename} level', name, obj)
+        override = _first_override(lookup, objects, names)
+        if override is None:
+            return True
 
-        return True
+        typename, obj, name, whitelist = override
+        if whitelist:
+            return True
+        raise PermissionDenied(f'{name} is denied on the {typename} level', name, obj)
 
     async def _display_embed(self, ctx, name=None, *entities, whitelist, type_):
         colour, action, icon = _value_embed_mappings[whitelist]
@@ -533,15 +635,60 @@ class Permissions(InitRoot):
         await self._display_embed(ctx, None, Server(ctx.guild),
                                   whitelist=-1, type_='All permissions')
 
+    @commands.command(name='auditperms', aliases=['permaudit'])
+    @commands.has_permissions(manage_guild=True)
+    async def audit_perms(self, ctx, *, entity: PermissionEntity=None):
+        """Shows which commands a member, role, or channel can use.
+
+        For members, the current channel is taken into account as well.
+        If nothing is specified, it shows what you can use in this channel.
+        """
+        entity = entity or ctx.author
+        lookup = await self._get_permissions(ctx.session, ctx.guild.id)
+        server = ('server', Server(ctx.guild))
+
+        if isinstance(entity, discord.Member):
+            roles = sorted((r for r in entity.roles if r.id in lookup), reverse=True)
+            objects = [('user', entity), *zip(itertools.repeat('role'), roles),
+                       ('channel', ctx.channel), server]
+        elif isinstance(entity, discord.Role):
+            objects = [('role', entity), server]
+        else:
+            objects = [('channel', entity), server]
+
+        # Everything is resolved against the same lookup in one go, so only
+        # the objects that actually have overrides need to be looked at.
+        objects = [(typename, obj) for typename, obj in objects if obj.id in lookup]
+
+        commands_ = sorted(
+            {c for c in ctx.bot.walk_commands()
+             if not (c.hidden or getattr(c.instance, '__hidden__', False))},
+            key=operator.attrgetter('qualified_name')
+        )
+
+        def lines():
+            for command in commands_:
+                override = _first_override(lookup, objects, _command_names(command))
+                if override is None or override[-1]:
+                    yield f'\N{WHITE HEAVY CHECK MARK} `{command}`'
+                else:
+                    yield f'\N{NO ENTRY SIGN} `{command}` (disabled on the {override[0]} level)'
+
+        pages = ListPaginator(ctx, list(lines()), title=f'Commands {entity} can use',
+                              lines_per_page=20)
+        await pages.interact()
+
     async def _bulk_ignore_entries(self, ctx, entries):
         guild_id = ctx.guild.id
-        query = ctx.session.select.from_(Plonks).where(Plonks.guild_id == guild_id)
+        ids = [e.id for e in unique(entries)]
+        # The index might still be loading, so this has to go through
+        # _get_plonks, otherwise existing plonks would break the COPY.
+        current_plonks = set(await self._get_plonks(ctx.session, guild_id, *ids))
+        to_insert = [(guild_id, id) for id in ids if id not in current_plonks]
 
-        current_plonks = {r.entity_id async for r in await query.all()}
-        to_insert = [(guild_id, e.id) for e in entries if e.id not in current_plonks]
-
-        conn = ctx.session.transaction.acquired_connection
+        conn = await ctx.session.connection()
         await conn.copy_records_to_table('plonks', columns=('guild_id', 'entity_id'), records=to_insert)
+        self._add_plonks(guild_id, (id for _, id in to_insert))
 
     async def _display_plonked(self, ctx, entries, plonk):
         # things = channels, members
@@ -578,6 +725,8 @@ class Permissions(InitRoot):
                 await ctx.send(f"I'm already ignoring {thing}...")
                 raise commands.UserInputError
 
+            self._add_plonks(ctx.guild.id, [thing.id])
+
         else:
             await self._bulk_ignore_entries(ctx, channels_or_members)
 
@@ -591,24 +740,23 @@ class Permissions(InitRoot):
         If no channel or member is specified, it unignores the current channel.
         """
         entities = channels_or_members or [ctx.channel]
-        condition = (Plonks.entity_id.in_(*(e.id for e in entities))
+        condition = (Plonks.entity_id == entities[0].id
                      if len(entities) == 1 else
-                     Plonks.entity_id == entities[0].id)
+                     Plonks.entity_id.in_(*(e.id for e in entities)))
 
         await ctx.session.delete.table(Plonks).where((Plonks.guild_id == ctx.guild.id) & condition)
+        self._remove_plonks(ctx.guild.id, [e.id for e in entities])
         await self._display_plonked(ctx, entities, plonk=False)
 
     @commands.command(aliases=['plonks'])
     @commands.has_permissions(manage_guild=True)
     async def ignores(self, ctx):
         """Tells you what channels or members are currently ignored in this server."""
-        query = ctx.session.select.from_(Plonks).where(Plonks.guild_id == ctx.guild.id)
         get_ch, get_m = ctx.guild.get_channel, ctx.guild.get_member
-        entries = [
-            (get_ch(e.entity_id) or get_m(e.entity_id) or _DummyEntry(e.entity_id)).mention
-            async for e in await query.all()
-        ]
-        entries.sort()
+        entries = sorted(
+            (get_ch(id) or get_m(id) or _DummyEntry(id)).mention
+            for id in await self._get_plonks(ctx.session, ctx.guild.id)
+        )
 
         if not entries:
             return await ctx.send("I'm not ignoring anything here...")
@@ -616,6 +764,35 @@ class Permissions(InitRoot):
         pages = ListPaginator(ctx, entries, title=f"Currently ignoring...", lines_per_page=20)
         await pages.interact()
 
+    @commands.command(name='permcachestats', hidden=True)
+    @commands.is_owner()
+    async def perm_cache_stats(self, ctx):
+        """Shows how the permissions cache is doing."""
+        get_permissions = self._get_permissions
+        cached = get_permissions.cache
+        hits, misses = get_permissions.get_stats()
+
+        # The names are interned, so they aren't counted here.
+        size = sys.getsizeof(cached) + sum(
+            sys.getsizeof(lookup) + sum(map(sys.getsizeof, lookup.values()))
+            for lookup in cached.values()
+        )
+
+        await ctx.send(f'{len(cached)}/{PERMISSIONS_CACHE_SIZE} servers cached '
+                       f'(~{size / 1024 :.2f} KiB)\n'
+                       f'{hits} hits, {misses} misses, '
+                       f'{pluralize(eviction=get_permissions.get_evictions())}.')
+
+    @commands.command(name='ignorestats', hidden=True)
+    @commands.is_owner()
+    async def ignore_stats(self, ctx):
+        """Shows how the in-memory ignore index is doing."""
+        stats = self._plonk_stats
+        entries = sum(map(len, self._plonks.values()))
+        await ctx.send(f'Ignoring {pluralize(entity=entries)} across {pluralize(server=len(self._plonks))} '
+                       f'({self._plonks_size() / 1024 :.2f} KiB)\n'
+                       f'{stats["hits"]} commands blocked, {stats["misses"]} let through.')
+
 
 def setup(bot):
     bot.add_cog(Permissions(bot))
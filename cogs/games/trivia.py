@@ -269,9 +269,8 @@ class OTDBTriviaSession(BaseTriviaSession):
         try:
             question = self._pending.pop()
         except IndexError:
-            async with self.ctx.bot.session.get('https://opentdb.com/api.php?amount=50') as resp:
-                results = await resp.json()
-                self._pending.extend(results['results'])
+            results = await self.ctx.bot.http_client.json('https://opentdb.com/api.php?amount=50')
+            self._pending.extend(results['results'])
             question = self._pending.pop()
 
         return _OTDBQuestion(
@@ -396,7 +395,7 @@ class Trivia:
         columns = ('category_id', 'question', 'answer', 'image')
         to_insert = [(row.id, *q) for q in category.questions]
 
-        conn = ctx.session.transaction.acquired_connection
+        conn = await ctx.session.connection()
         await conn.copy_records_to_table('trivia_questions', columns=columns, records=to_insert)
         await ctx.send('\N{OK HAND SIGN}')
 
@@ -18,7 +18,7 @@ from itertools import chain, islice, starmap
 from math import log10
 from operator import attrgetter
 
-from .utils import cache, disambiguate
+from .utils import cache, disambiguate, http
 from .utils.colours import url_color, user_color
 from .utils.context_managers import redirect_exception, temp_message
 from .utils.converter import BotCommand, union
@@ -38,9 +38,14 @@ else:
     del pkg_resources
 
 
-async def _mee6_stats(session, member):
-    async with session.get(f"https://mee6.xyz/levels/{member.guild.id}?json=1&limit=-1") as r:
-        levels = await r.json(content_type=None)
+# limit=-1 returns every player in the server, which can easily be more than
+# the usual cap for big servers.
+_MEE6_MAX_SIZE = 64 * 1024 * 1024
+
+
+async def _mee6_stats(http_client, member):
+    url = f"https://mee6.xyz/levels/{member.guild.id}?json=1&limit=-1"
+    levels = await http_client.json(url, max_size=_MEE6_MAX_SIZE)
     for idx, user_stats in enumerate(levels['players'], start=1):
         if user_stats.get("id") == str(member.id):
             user_stats["rank"] = idx
@@ -254,9 +259,11 @@ class Meta:
         avatar_url = member.avatar_url
 
         no_mee6_in_server = "No stats found. You don't have mee6 in this server... I think."
-        with redirect_exception((json.JSONDecodeError, no_mee6_in_server)):
+        with redirect_exception((json.JSONDecodeError, no_mee6_in_server),
+                                (aiohttp.ClientResponseError, no_mee6_in_server),
+                                (http.ResponseTooLarge, "This server has too many mee6 stats for me to read...")):
             async with ctx.typing(), temp_message(ctx, "Fetching data, please wait...") as message:
-                stats = await _mee6_stats(ctx.bot.session, member)
+                stats = await _mee6_stats(ctx.bot.http_client, member)
 
         description = f"Currently sitting at {stats['rank']}!"
         xp_progress = "{xp}/{lvl_xp} ({xp_percent}%)".format(**stats)
@@ -119,7 +119,11 @@ class Moderator:
         self.bot = bot
         self._md = self.bot.db.bind_tables(_Table)
 
-        self.slowmodes = JSONFile('slowmodes.json')
+        self.slowmodes = JSONFile('slowmodes.json', key_type=int)
+        # The channels and members in each config are ints too, for the
+        # same reason. json turns them back into strings when it's saved.
+        for guild_id, config in self.slowmodes.items():
+            self.slowmodes[guild_id] = {int(k): v for k, v in config.items()}
         self.slowmode_bucket = {}
 
     async def call_mod_log_invoke(self, invoke, ctx):
@@ -150,11 +154,10 @@ class Moderator:
         is_immune = self._is_slowmode_immune(author)
 
         for thing in (message.channel, author):
-            key = str(thing.id)
-            if key not in slowmodes:
+            config = slowmodes.get(thing.id)
+            if config is None:
                 continue
 
-            config = slowmodes[key]
             if not config['no_immune'] and is_immune:
                 continue
 
@@ -190,7 +193,7 @@ class Moderator:
             return await ctx.send(message)
 
         config = self.slowmodes.get(ctx.guild.id, {})
-        slowmode = config.setdefault(str(member.id), {'no_immune': False})
+        slowmode = config.setdefault(member.id, {'no_immune': False})
         if slowmode['no_immune']:
             return await ctx.send(f'{member.mention} is already in **no-immune** slowmode. '
                                    'You need to turn it off first.')
@@ -217,9 +220,9 @@ class Moderator:
             pronoun = 'Everyone'
 
         config = self.slowmodes.get(ctx.guild.id, {})
-        slowmode = config.setdefault(str(member.id), {'no_immune': True})
+        slowmode = config.setdefault(member.id, {'no_immune': True})
         slowmode['duration'] = duration
-        await self.slowmodes.put(ctx.guild, config)
+        await self.slowmodes.put(ctx.guild.id, config)
 
         await ctx.send(f'{member.mention} is now in **no-immune** slowmode! '
                        f'{pronoun} must wait {time.duration_units(duration)} '
@@ -231,7 +234,7 @@ class Moderator:
         member = member or ctx.channel
         config = self.slowmodes.get(ctx.guild.id, {})
         try:
-            del config[str(member.id)]
+            del config[member.id]
         except KeyError:
             return await ctx.send(f'{member.mention} was never in slowmode... \N{NEUTRAL FACE}')
         else:
@@ -592,53 +595,23 @@ class Moderator:
         if role not in member.roles:
             return await ctx.send(f'{member} is not muted...')
 
-        # This fourth condition is in case we have this scenario:
+        # The role is checked as well in case we have this scenario:
         # - Member was muted
         # - Mute role was changed while the user was muted
         # - Member was muted again with the new role.
-        query = """SELECT expires
-                   FROM schedule
-                   WHERE event = 'mute_complete'
-                   AND args_kwargs #>> '{args,0}' = $1
-                   AND args_kwargs #>> '{args,1}' = $2
-                   AND args_kwargs #>> '{args,2}' = $3
-                   LIMIT 1;
-                """
-
-        # We have to go to the lowest level possible, because simply using
-        # ctx.session.cursor WILL NOT work, as it uses str.format to format
-        # the parameters, which will throw a KeyError due to the {} in the
-        # JSON operators.
-        session = ctx.session.transaction.acquired_connection
-        entry = await session.fetchrow(query, str(ctx.guild.id), str(member.id), str(role.id))
-        if entry is None:
+        entries = await ctx.bot.db_scheduler.find('mute_complete', ctx.guild.id, member.id, role.id,
+                                                  limit=1)
+        if not entries:
             return await ctx.send(f"{member} has been perm-muted, you must've "
                                   "added the role manually or something...")
 
-        when = entry['expires']
+        when = entries[0].time
         await ctx.send(f'{member} has {time.human_timedelta(when)} remaining. '
                        f'They will be unmuted on {when: %c}.')
 
-    async def _remove_time_entry(self, guild, member, session, *, event='mute_complete'):
-        query = """SELECT *
-                   FROM schedule
-                   WHERE event = $3
-                   AND args_kwargs #>> '{args,0}' = $1
-                   AND args_kwargs #>> '{args,1}' = $2
-                   ORDER BY expires
-                   LIMIT 1;
-                """
-        # We have to go to the lowest level possible, because simply using
-        # session.cursor WILL NOT work, as it uses str.format to format
-        # the parameters, which will throw a KeyError due to the {} in the
-        # JSON operators.
-        session = session.transaction.acquired_connection
-        entry = await session.fetchrow(query, str(guild.id), str(member.id), event)
-        if entry is None:
-            return None
-
-        await self.bot.db_scheduler.remove(discord.Object(id=entry['id']))
-        return entry
+    async def _remove_time_entry(self, guild, member, *, event='mute_complete'):
+        entries = await self.bot.db_scheduler.remove_where(event, guild.id, member.id, limit=1)
+        return entries[0] if entries else None
 
     @commands.command(usage=['@rjt#2336 sorry bb'])
     @commands.has_permissions(manage_messages=True)
@@ -649,7 +622,7 @@ class Moderator:
             return await ctx.send(f"{member} hasn't been muted!")
 
         await member.remove_roles(role)
-        await self._remove_time_entry(member.guild, member, ctx.session)
+        await self._remove_time_entry(member.guild, member)
         await ctx.send(f'{member.mention} can now speak again... '
                         '\N{SMILING FACE WITH OPEN MOUTH AND COLD SWEAT}')
 
@@ -737,7 +710,7 @@ class Moderator:
         """Unbans the user (obviously)"""
 
         await ctx.guild.unban(user.user)
-        await self._remove_time_entry(ctx.guild, user, ctx.session, event='tempban_complete')
+        await self._remove_time_entry(ctx.guild, user, event='tempban_complete')
         await ctx.send(f"Done. What did {user.user} do to get banned in the first place...?")
 
     @commands.command(usage='"theys f-ing up shit" @user1#0000 105635576866156544 user2#0001 user3')
@@ -790,11 +763,10 @@ class Moderator:
 
     async def on_member_join(self, member):
         # Prevent mute-evasion
-        async with self.bot.db.get_session() as session:
-            entry = await self._remove_time_entry(member.guild, member, session)
-            if entry:
-                # mute them for an extra 60 mins
-                await self._do_mute(member, entry['expires'] + datetime.timedelta(seconds=3600))
+        entry = await self._remove_time_entry(member.guild, member)
+        if entry:
+            # mute them for an extra 60 mins
+            await self._do_mute(member, entry.time + datetime.timedelta(seconds=3600))
 
     async def on_member_update(self, before, after):
         # In the event of a manual unmute, this has to be covered.
@@ -804,12 +776,11 @@ class Moderator:
 
         role = await self._get_muted_role(before.guild)
         if role in removed_roles:
-            async with self.bot.db.get_session() as session:
-                # We need to remove this guy from the scheduler in the event of
-                # a manual unmute. Because if the guy was muted again, the old
-                # mute would still be in effect. So it would just remove the
-                # muted role.
-                await self._remove_time_entry(before.guild, before, session)
+            # We need to remove this guy from the scheduler in the event of
+            # a manual unmute. Because if the guy was muted again, the old
+            # mute would still be in effect. So it would just remove the
+            # muted role.
+            await self._remove_time_entry(before.guild, before)
 
     # XXX: Should I even bother to remove unbans from the scheduler in the event
     #      of a manual unban?
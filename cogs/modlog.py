@@ -106,7 +106,9 @@ def _is_mod_action(ctx):
     return ctx.command.qualified_name in _mod_actions
 
 
-@cache.cache(maxsize=512)
+# Messages that were deleted are cached for a shorter time, in case it was
+# just Discord being weird.
+@cache.cache(maxsize=512, ttl=60 * 20, negative_ttl=60 * 5)
 async def _get_message(channel, message_id):
     o = discord.Object(id=message_id + 1)
     # don't wanna use get_message due to poor rate limit (1/1s) vs (50/1s)
@@ -117,7 +119,7 @@ async def _get_message(channel, message_id):
 
     return msg
 
-@cache.cache(maxsize=None, make_key=lambda a, kw: a[-1])
+@cache.cache(maxsize=None, make_key=lambda a, kw: a[-1], coalesce=False)
 async def _get_number_of_cases(session, guild_id):
     query = "SELECT COUNT(*) FROM modlog WHERE guild_id={guild_id};"
     params = {'guild_id': guild_id}
@@ -148,19 +150,9 @@ class ModLog:
     def __init__(self, bot):
         self.bot = bot
         self._md = bot.db.bind_tables(_Table)
-        self._cache_cleaner = asyncio.ensure_future(self._clean_cache())
         self._cache_locks = collections.defaultdict(asyncio.Event)
         self._cache = set()
 
-    def __unload(self):
-        self._cache_cleaner.cancel()
-
-    async def _clean_cache(self):
-        # Used to clear the message cache every now and then
-        while True:
-            await asyncio.sleep(60 * 20)
-            _get_message.cache.clear()
-
     async def _get_case_config(self, session, guild_id):
         query = (session.select.from_(ModLogConfig)
                         .where(ModLogConfig.guild_id == guild_id)
@@ -241,7 +233,13 @@ class ModLog:
         else:
             columns = ('entry_id', 'user_id')
             to_insert = [(entry_id, t.id) for t in targets]
-            conn = session.transaction.acquired_connection
+            # Only ctx.session can acquire its connection on demand. The one
+            # from polling the audit log is a plain session that's started
+            # by now, since _send_case has already gone through it.
+            if hasattr(session, 'connection'):
+                conn = await session.connection()
+            else:
+                conn = session.transaction.acquired_connection
             await conn.copy_records_to_table('modlog_targets', columns=columns, records=to_insert)
 
     async def _notify_user(self, config, action, server, user, targets, reason, 
@@ -719,6 +717,7 @@ class ModLog:
         except discord.NotFound:
             # In case the message was cached, and the message was deleted
             # While it was still in the cache.
+            _get_message.invalidate(channel, case.message_id)
             return await ctx.send('Somehow this message was deleted...')
 
         case.reason = reason
@@ -190,8 +190,7 @@ class OtherStuffs:
     # -------------------- SHIP -------------------
     async def _load_user_avatar(self, user):
         url = user.avatar_url_as(format='png', size=512)
-        async with self.bot.session.get(url) as r:
-            return await r.read()
+        return await self.bot.http_client.read(url)
 
     def _create_ship_image(self, score, avatar1, avatar2):
         ava_im1 = Image.open(avatar1).convert('RGBA')
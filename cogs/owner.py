@@ -4,11 +4,13 @@ import discord
 import inspect
 import io
 import itertools
+import json
 import textwrap
 import traceback
 
 from discord.ext import commands
 
+from .utils import cache
 from .utils.context_managers import temp_attr
 
 
@@ -156,6 +158,35 @@ class Owner:
         else:
             await ctx.send(fmt)
 
+    @commands.command(name='cachestats')
+    async def cache_stats(self, ctx, dump: bool = False):
+        """Shows how all the caches are doing.
+
+        Pass "yes" to get the raw stats as a JSON file instead.
+        """
+        stats = cache.stats()
+        if dump:
+            fp = io.BytesIO(json.dumps(stats, indent=4).encode('utf-8'))
+            return await ctx.send(file=discord.File(fp, 'cache_stats.json'))
+
+        if not stats:
+            return await ctx.send('Nothing is being cached right now...')
+
+        headers = ['name', 'size', 'hits', 'misses', 'evictions', 'KiB']
+        rows = (
+            (s['name'].replace('cogs.', '', 1), f"{s['size']}/{s['maxsize'] or '∞'}",
+             s['hits'], s['misses'], s['evictions'], f"{s['bytes'] / 1024 :.2f}")
+            for s in stats
+        )
+        rendered = _tabulate(rows, headers)
+
+        fmt = f'```\n{rendered}\n```'
+        if len(fmt) > 2000:
+            fp = io.BytesIO(rendered.encode('utf-8'))
+            await ctx.send('Too many caches...', file=discord.File(fp, 'cache_stats.txt'))
+        else:
+            await ctx.send(fmt)
+
     @commands.command()
     async def botav(self, ctx, *, avatar):
         with open(avatar, 'rb') as f:
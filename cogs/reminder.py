@@ -1,7 +1,6 @@
 import contextlib
 import discord
 import itertools
-import json
 import parsedatetime
 
 from discord.ext import commands
@@ -82,32 +81,20 @@ class Reminder:
 
         You can't cancel reminders that you've set to go off in 30 seconds or less.
         """
-        query = """SELECT *
-                   FROM schedule
-                   WHERE event = 'reminder_complete'
-                   AND args_kwargs #>> '{args,0}' = $1
-                   ORDER BY expires
-                   OFFSET $2
-                   LIMIT 1;
-                """
-
-        # We have to go to the lowest level possible, because simply using
-        # ctx.session.cursor WILL NOT work, as it uses str.format to format
-        # the parameters, which will throw a KeyError due to the {} in the
-        # JSON operators.
-        session = ctx.session.transaction.acquired_connection
-        entry = await session.fetchrow(query, str(ctx.author.id), index - 1)
-        if entry is None:
+        scheduler = ctx.bot.db_scheduler
+        entries = await scheduler.find('reminder_complete', ctx.author.id, offset=index - 1, limit=1)
+        if not entries:
             return await ctx.send(f'Reminder #{index} does not exist... baka...')
 
-        await ctx.bot.db_scheduler.remove(discord.Object(id=entry['id']))
+        entry = entries[0]
+        await scheduler.remove(entry)
 
-        _, channel_id, message = json.loads(entry['args_kwargs'])['args']
+        _, channel_id, message = entry.args
         channel = self.bot.get_channel(channel_id) or 'deleted-channel'
         # In case the channel doesn't exist anymore
         server = getattr(channel, 'guild', None)
 
-        embed = (discord.Embed(colour=0xFF0000, description=message, timestamp=entry['expires'])
+        embed = (discord.Embed(colour=0xFF0000, description=message, timestamp=entry.time)
                 .set_author(name=f'Reminder #{index} cancelled!', icon_url=CANCELED_URL)
                 .add_field(name='Was for', value=f'{channel} in {server}')
                 .set_footer(text='Was set to go off at')
@@ -121,24 +108,15 @@ class Reminder:
 
         Reminder that you've set to go off in 30 seconds or less will not be shown, however.
         """
-        query = """SELECT created, expires, args_kwargs #>> '{args,1}', args_kwargs #>> '{args,2}'
-                   FROM schedule
-                   WHERE event = 'reminder_complete'
-                   AND args_kwargs #>> '{args,0}' = $1
-                   ORDER BY expires;
-                """
-        # We have to go to the lowest level possible, because simply using
-        # ctx.session.cursor WILL NOT work, as it uses str.format to format
-        # the parameters, which will throw a KeyError due to the {} in the
-        # JSON operators.
-        session = ctx.session.transaction.acquired_connection
-        reminders = await session.fetch(query, str(ctx.author.id))
+        reminders = await ctx.bot.db_scheduler.find('reminder_complete', ctx.author.id)
 
         if not reminders:
             return await ctx.send("You have no reminders at the moment.")
 
         def entries():
-            for i, (created, expires, channel_id, message) in enumerate(reminders, start=1):
+            for i, entry in enumerate(reminders, start=1):
+                expires = entry.time
+                _, channel_id, message = entry.args
                 channel = f'<#{channel_id}>' if channel_id else 'Direct Message'
 
                 name = f'{i}. In {human_timedelta(expires)} from now.'
@@ -1,10 +1,14 @@
 import aiohttp
+import asyncio
 import asyncqlio
+import contextlib
 import discord
 import datetime
 import itertools
+import logging
 import math
 import psutil
+import time
 import traceback
 
 from discord.ext import commands
@@ -17,6 +21,8 @@ from .utils.paginator import ListPaginator, EmbedFieldPages
 from .utils.time import human_timedelta
 
 
+log = logging.getLogger(__name__)
+
 _Table = asyncqlio.table_base()
 _ignored_exceptions = (
     commands.NoPrivateMessage,
@@ -46,28 +52,103 @@ class Command(_Table, table_name='commands'):
     commands_command_idx = asyncqlio.Index(command)
 
 
+class _CommandUsageRecorder:
+    """Buffers command usages in memory and writes them to the DB in bulk.
+
+    Rows are flushed through COPY once ``max_size`` of them have piled up,
+    or every ``interval`` seconds, whichever comes first. If a flush fails
+    the rows are put back in the buffer so the next flush can retry them.
+    """
+    COLUMNS = ('guild_id', 'channel_id', 'author_id', 'used', 'prefix', 'command')
+
+    def __init__(self, db, *, loop, max_size=100, interval=10):
+        self.max_size = max_size
+        self.interval = interval
+        self.last_flush_latency = None
+        self.failed_flushes = 0
+
+        self._db = db
+        self._buffer = []
+        self._lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        self._loop = loop
+        self._runner = loop.create_task(self._run())
+        self._closing = None
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def add(self, record):
+        self._buffer.append(record)
+        if len(self._buffer) >= self.max_size:
+            self._full.set()
+
+    async def _run(self):
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            self._full.clear()
+
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error('Flushing %d command usages failed: %r', len(self), e)
+                # Don't hammer the DB while it's having a bad time.
+                await asyncio.sleep(self.interval)
+
+    async def flush(self):
+        async with self._lock:
+            if not self._buffer:
+                return
+
+            batch, self._buffer = self._buffer, []
+            start = time.perf_counter()
+            try:
+                async with self._db.get_session() as session:
+                    conn = session.transaction.acquired_connection
+                    await conn.copy_records_to_table('commands', columns=self.COLUMNS, records=batch)
+            except BaseException:
+                # This includes getting cancelled, e.g. by close() while the
+                # runner is in the middle of a flush.
+                #
+                # Anything that came in during the flush goes after the batch.
+                self._buffer[:0] = batch
+                self.failed_flushes += 1
+                raise
+
+            self.last_flush_latency = time.perf_counter() - start
+
+    async def close(self):
+        """Stops the background flushing and writes out whatever is left.
+
+        Calling this more than once just waits for the first call to finish.
+        """
+        if self._closing is None:
+            self._runner.cancel()
+            self._closing = self._loop.create_task(self.flush())
+        await asyncio.shield(self._closing)
+
+
 class Stats:
     def __init__(self, bot):
         self.bot = bot
         self._md = self.bot.db.bind_tables(_Table)
         self.process = psutil.Process()
+        self._usages = _CommandUsageRecorder(bot.db, loop=bot.loop)
+
+    def __unload(self):
+        self.bot.loop.create_task(self._usages.close())
+
+    async def __shutdown(self):
+        await self._usages.close()
 
     async def on_command(self, ctx):
         command = ctx.command.qualified_name
         self.bot.command_leaderboard[command] += 1
 
         guild_id = None if ctx.guild is None else ctx.guild.id
-        row = Command(
-            guild_id=guild_id,
-            channel_id=ctx.channel.id,
-            author_id=ctx.author.id,
-            used=ctx.message.created_at,
-            prefix=ctx.prefix,
-            command=command,
-        )
-
-        async with ctx.db.get_session() as s:
-            await s.add(row)
+        self._usages.add((guild_id, ctx.channel.id, ctx.author.id,
+                          ctx.message.created_at, ctx.prefix, command))
 
     async def _show_top_commands(self, ctx, n, entries):
         padding = int(math.log10(n)) + 1
@@ -134,6 +215,12 @@ class Stats:
         average_messages = bot.message_counter / uptime_seconds
         message_field = f'{bot.message_counter} messages\n({average_messages :.2f} messages/sec)'
 
+        usages = self._usages
+        latency = usages.last_flush_latency
+        latency = 'N/A' if latency is None else f'{latency * 1000 :.2f}ms'
+        usage_field = (f'{len(usages)} buffered\nLast flush: {latency}\n'
+                       f'{pluralize(failure=usages.failed_flushes)}')
+
         text, voice = partition(lambda c: isinstance(c, discord.TextChannel), bot.get_all_channels())
         presence = (f"{len(bot.guilds)} Servers\n{ilen(text)} Text Channels\n"
                     f"{ilen(voice)} Voice Channels\n{len(bot.users)} Users")
@@ -145,6 +232,7 @@ class Stats:
                         .add_field(name='Messages', value=message_field)
                         .add_field(name='Presence', value=presence)
                         .add_field(name='Commands', value=command_stats)
+                        .add_field(name='Command Log', value=usage_field)
                         .add_field(name='Uptime', value=self.bot.str_uptime.replace(', ', '\n'))
                         )
         await ctx.send(embed=chiaki_embed)
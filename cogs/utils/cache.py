@@ -1,12 +1,16 @@
 import asyncio
+import collections
 import enum
 import functools
 import inspect
+import sys
+import time
 
 from lru import LRU
 
 
 _keyword_marker = object()
+_missing = object()
 
 # Key-making functions
 def unordered(args, kwargs):
@@ -18,24 +22,182 @@ default_key = functools.partial(functools._make_key, typed=False)
 typed_key = functools.partial(functools._make_key, typed=True)
 
 
+class _Expiring(collections.namedtuple('_Expiring', 'value expires')):
+    __slots__ = ()
+
+    def expired(self, now):
+        return self.expires is not None and self.expires <= now
+
+
+# Every cached function, by its qualified name, along with any other cache
+# that was registered. Reloading an extension just replaces its entries.
+_registry = {}
+
+
+def _sizeof(obj):
+    # Only goes one level deep. It's an estimate, not an audit.
+    size = sys.getsizeof(obj)
+    if isinstance(obj, _Expiring):
+        return size + _sizeof(obj.value)
+    if isinstance(obj, dict):
+        return size + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return size + sum(map(sys.getsizeof, obj))
+    return size
+
+
+def register(name, obj):
+    """Adds a cache that isn't a cached function to stats().
+
+    obj must have a get_info() that returns the same keys as a cached
+    function's.
+    """
+    _registry[name] = obj
+
+
+def registered():
+    """Returns a list of every cached function and registered cache."""
+    return list(_registry.values())
+
+
+def stats():
+    """Returns the info of every cache, sorted by name."""
+    return sorted((f.get_info() for f in _registry.values()), key=lambda info: info['name'])
+
+
 # From Danny's cache.py, just with some modifications to allow for
 # custom key args, and the strategy is determined by the maxsize arg.
 # https://github.com/Rapptz/RoboDanny/blob/rewrite/cogs/utils/cache.py
-def cache(maxsize=128, make_key=default_key):
+#
+# ttl is how many seconds a result stays valid for, and negative_ttl is the
+# same for results that are None (e.g. something that couldn't be found).
+# A negative_ttl of 0 means None is never cached. Expired entries are only
+# thrown out when they're looked up, unless sweep_interval is given, in
+# which case they're also swept out every sweep_interval seconds.
+#
+# Concurrent misses on the same key share one call, unless coalesce is False.
+# Turn that off for functions that take something tied to the caller, like a
+# DB session, since everyone would be waiting on the first caller's session
+# (which might be gone by the time the call is done).
+def cache(maxsize=128, make_key=default_key, *, ttl=None, negative_ttl=None,
+          sweep_interval=None, coalesce=True):
     def decorator(func):
+        # Counted here rather than with LRU.get_stats, since that doesn't
+        # exist for the unbounded cache, and an LRU lookup that finds an
+        # expired entry would still count as a hit.
+        hits = misses = evictions = 0
+
+        def count_eviction(key, value):
+            nonlocal evictions
+            evictions += 1
+
         if maxsize is None:
             cache = {}
-            get_stats = lambda: (0, 0)
         else:
-            cache = LRU(maxsize)
-            get_stats = cache.get_stats
+            cache = LRU(maxsize, count_eviction)
+
+        def get_stats():
+            return hits, misses
+
+        timed = ttl is not None or negative_ttl is not None
+        sweeper = None
+
+        def get(key):
+            value = cache[key]
+            if not timed:
+                return value
+
+            if value.expired(time.monotonic()):
+                del cache[key]
+                raise KeyError(key)
+            return value.value
+
+        def put(key, value):
+            if not timed:
+                cache[key] = value
+                return
+
+            lifetime = ttl
+            if value is None and negative_ttl is not None:
+                lifetime = negative_ttl
+
+            if lifetime is None:
+                cache[key] = _Expiring(value, None)
+            elif lifetime > 0:
+                cache[key] = _Expiring(value, time.monotonic() + lifetime)
+                start_sweeping()
+
+        def sweep():
+            """Removes all the expired entries. Returns how many were removed."""
+            if not timed:
+                return 0
+
+            now = time.monotonic()
+            expired = [key for key, value in cache.items() if value.expired(now)]
+            for key in expired:
+                del cache[key]
+            return len(expired)
+
+        async def sweep_forever():
+            while True:
+                await asyncio.sleep(sweep_interval)
+                sweep()
+
+        def start_sweeping():
+            nonlocal sweeper
+            if sweep_interval is not None and (sweeper is None or sweeper.done()):
+                sweeper = asyncio.ensure_future(sweep_forever())
+
+        def stop_sweeping():
+            nonlocal sweeper
+            if sweeper is not None:
+                sweeper.cancel()
+                sweeper = None
+
+        # Coroutines that are still running, so that concurrent misses on
+        # the same key all wait on the one call instead of making their own.
+        pending = {}
+
+        def store(key, task):
+            # Failures are passed on to whoever is waiting, but not cached.
+            if task.cancelled() or task.exception() is not None:
+                value = _missing
+            else:
+                value = task.result()
+
+            # If the key was invalidated while the coroutine was running, the
+            # result might be stale already, so don't store it.
+            if pending.get(key) is task:
+                del pending[key]
+                if value is not _missing:
+                    put(key, value)
+
+        async def wait_for(task):
+            # Shielded so one caller getting cancelled doesn't cancel the
+            # call for everyone else.
+            return await asyncio.shield(task)
 
         def wrap_and_store(key, coro):
-            async def func():
+            task = asyncio.ensure_future(coro)
+            pending[key] = task
+            task.add_done_callback(functools.partial(store, key))
+            return wait_for(task)
+
+        async def call_and_store(key, coro):
+            # Not coalesced, so this runs in the caller's own task. The marker
+            # is only there so an invalidation during the call is noticed.
+            marker = pending[key] = object()
+            try:
                 value = await coro
-                cache[key] = value
-                return value
-            return func()
+            except BaseException:
+                if pending.get(key) is marker:
+                    del pending[key]
+                raise
+
+            if pending.get(key) is marker:
+                del pending[key]
+                put(key, value)
+            return value
 
         def wrap_new(value):
             async def new_coroutine():
@@ -44,20 +206,36 @@ def cache(maxsize=128, make_key=default_key):
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
+            nonlocal hits, misses
             key = make_key(args, kwargs)
             # try/except might be slow if the key is constantly not in the cache.
             # I wonder if it's faster to use cache.get and compare to a sentinel.
             try:
-                value = cache[key]
+                value = get(key)
             except KeyError:
+                if coalesce:
+                    try:
+                        task = pending[key]
+                    except KeyError:
+                        pass
+                    else:
+                        # Someone else is already getting it, so this is as
+                        # good as a hit.
+                        hits += 1
+                        return wait_for(task)
+
+                misses += 1
                 value = func(*args, **kwargs)
 
                 if inspect.isawaitable(value):
+                    if not coalesce:
+                        return call_and_store(key, value)
                     return wrap_and_store(key, value)
 
-                cache[key] = value
+                put(key, value)
                 return value
             else:
+                hits += 1
                 if asyncio.iscoroutinefunction(func):
                     return wrap_new(value)
                 return value
@@ -68,8 +246,10 @@ def cache(maxsize=128, make_key=default_key):
             #
             # _sentinel = object()
             # return cache.pop(make_key(args, kwargs), _sentinel) is not _sentinel
+            key = make_key(args, kwargs)
+            pending.pop(key, None)
             try:
-                del cache[make_key(args, kwargs)]
+                del cache[key]
             except KeyError:
                 return False
             else:
@@ -79,6 +259,26 @@ def cache(maxsize=128, make_key=default_key):
         wrapper.get_key = lambda *a, **kw: make_key(a, kw)
         wrapper.invalidate = invalidate
         wrapper.get_stats = get_stats
+        wrapper.get_evictions = lambda: evictions
+        def get_info():
+            hits, misses = get_stats()
+            return {
+                'name': name,
+                'maxsize': maxsize,
+                'size': len(cache),
+                'hits': hits,
+                'misses': misses,
+                'evictions': evictions,
+                'bytes': sys.getsizeof(cache) + sum(
+                    sys.getsizeof(k) + _sizeof(v) for k, v in cache.items()
+                ),
+            }
+
+        name = f'{func.__module__}.{func.__qualname__}'
+        wrapper.sweep = sweep
+        wrapper.stop_sweeping = stop_sweeping
+        wrapper.get_info = get_info
+        register(name, wrapper)
         return wrapper
     return decorator
 
@@ -1,29 +1,262 @@
-import aiohttp
 import asyncio
+import collections
+import concurrent.futures
 import discord
-import functools
+import hashlib
+import os
+import tempfile
 
 from colorthief import ColorThief
 from io import BytesIO
 
-from . import cache
+from . import cache, http
+
+try:
+    import numpy
+    from PIL import Image
+except ImportError:
+    numpy = None
+
+
+class _ImageCache:
+    """An LRU of raw image bytes that's capped by size rather than count.
+
+    If spill_dir is given, images that get pushed out of memory are written
+    there instead, named after the hash of their contents, and read back from
+    there if they're needed again. The spill directory has its own cap.
+    """
+
+    def __init__(self, max_bytes, *, spill_dir=None, max_spill_bytes=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self._images = collections.OrderedDict()
+        # url -> (digest, size)
+        self._spilled = collections.OrderedDict()
+        self._spilled_size = 0
+        self._digests = collections.Counter()
+        # Every file operation goes through this one thread, so they happen in
+        # the order they were made. Otherwise a file could be removed before
+        # it was written, or read before it was done.
+        self._io = None
+
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._io = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def __len__(self):
+        return len(self._images)
+
+    def _path(self, digest):
+        return os.path.join(self.spill_dir, digest)
+
+    async def get(self, url):
+        try:
+            data = self._images[url]
+        except KeyError:
+            pass
+        else:
+            self._images.move_to_end(url)
+            self.hits += 1
+            return data
+
+        spilled = self._spilled.pop(url, None)
+        if spilled is not None:
+            digest, size = spilled
+            self._spilled_size -= size
+            loop = asyncio.get_event_loop()
+            try:
+                data = await loop.run_in_executor(self._io, _read_file, self._path(digest))
+            except OSError:
+                data = None
+            finally:
+                self._unref(digest)
+
+            if data is not None:
+                self.hits += 1
+                self.put(url, data)
+                return data
+
+        self.misses += 1
+        return None
+
+    def put(self, url, data):
+        if len(data) > self.max_bytes:
+            # It would just push everything else out, and then itself.
+            return
+
+        old = self._images.pop(url, None)
+        if old is not None:
+            self.size -= len(old)
+
+        self._images[url] = data
+        self.size += len(data)
+
+        while self.size > self.max_bytes:
+            url, data = self._images.popitem(last=False)
+            self.size -= len(data)
+            self.evictions += 1
+            self._spill(url, data)
+
+    def _spill(self, url, data):
+        if self.spill_dir is None:
+            return
+
+        digest = hashlib.sha1(data).hexdigest()
+        self._spilled[url] = digest, len(data)
+        self._spilled_size += len(data)
+        self._digests[digest] += 1
+
+        loop = asyncio.get_event_loop()
+        loop.run_in_executor(self._io, _write_file, self._path(digest), data)
+
+        if self.max_spill_bytes is None:
+            return
+
+        while self._spilled_size > self.max_spill_bytes:
+            _, (digest, size) = self._spilled.popitem(last=False)
+            self._spilled_size -= size
+            self._unref(digest)
+
+    def _unref(self, digest):
+        # Identical images (e.g. default avatars) share the same file, so it
+        # can only go once nothing is using it.
+        self._digests[digest] -= 1
+        if self._digests[digest] <= 0:
+            del self._digests[digest]
+            loop = asyncio.get_event_loop()
+            loop.run_in_executor(self._io, _remove_file, self._path(digest))
+
+    def clear(self):
+        self._images.clear()
+        self.size = 0
+
+    def get_info(self):
+        # The cap is on the bytes, not the number of images.
+        return {
+            'name': f'{__name__}._images',
+            'maxsize': None,
+            'size': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'bytes': self.size,
+        }
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _write_file(path, data):
+    # Content-addressed, so if it's there it's already the right thing.
+    if os.path.exists(path):
+        return
+
+    # Written to a temporary file first so a half-written image is never read.
+    directory, name = os.path.split(path)
+    with tempfile.NamedTemporaryFile(dir=directory, prefix=name, delete=False) as f:
+        f.write(data)
+    os.replace(f.name, path)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# The images are only needed to get their dominant colour, which is cached
+# separately, so this doesn't have to be big.
+_images = _ImageCache(64 * 1024 * 1024)
+cache.register(f'{__name__}._images', _images)
 
 
-@cache.cache(maxsize=4096)
 async def _read_image_from_url(url):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as resp:
-            return await resp.read()
+    data = await _images.get(url)
+    if data is not None:
+        return data
+
+    data = await http.shared_client().read(url)
+
+    _images.put(url, data)
+    return data
+
+
+def _dominant_colour(data, *, size=64, boxes=8):
+    """Returns the dominant colour of an image as an rgb tuple.
+
+    The image is shrunk down first, then its pixels are split into boxes
+    (median cut, except each box is split at the middle of its widest channel
+    rather than at the median, so the boxes end up with different amounts of
+    pixels). The dominant colour is the average of the fullest box.
+    """
+    with Image.open(BytesIO(data)) as image:
+        image = image.convert('RGBA')
+        image.thumbnail((size, size))
+        pixels = numpy.asarray(image).reshape(-1, 4)
+
+    # Same as ColorThief, ignore pixels that are see-through or nearly white.
+    keep = (pixels[:, 3] >= 125) & ~(pixels[:, :3] > 250).all(axis=1)
+    pixels = pixels[keep, :3].astype(numpy.int16)
+    if not len(pixels):
+        return 255, 255, 255
+
+    found = [pixels]
+    while len(found) < boxes:
+        # Split whichever box covers the most colours, by pixel count.
+        ranges = [numpy.ptp(box, axis=0) for box in found]
+        index = max(range(len(found)), key=lambda i: len(found[i]) * int(ranges[i].max()))
+        box, channel = found[index], ranges[index].argmax()
+        if not ranges[index][channel]:
+            break
+
+        middle = box[:, channel].min() + ranges[index][channel] // 2
+        lower = box[:, channel] <= middle
+        found[index:index + 1] = box[lower], box[~lower]
+
+    fullest = max(found, key=len)
+    return tuple(int(c) for c in fullest.mean(axis=0).round())
+
+
+def _colour_thief(data):
+    with BytesIO(data) as f:
+        return ColorThief(f).get_color(quality=1)
+
+
+# Getting the colour is CPU-bound, so it's done in another process to keep
+# it from holding the GIL. Created when it's first needed.
+_pool = None
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = concurrent.futures.ProcessPoolExecutor(max_workers=2)
+    return _pool
+
+
+async def shutdown():
+    """Stops the worker processes. They're started again if they're needed."""
+    global _pool
+    pool, _pool = _pool, None
+    if pool is not None:
+        # Waiting for the workers blocks, so it's done in a thread.
+        await asyncio.get_event_loop().run_in_executor(None, pool.shutdown)
 
 
 @cache.cache(maxsize=4096)
 async def _dominant_color_from_url(url):
     """Returns an rgb tuple consisting the dominant color given a image url."""
-    with BytesIO(await _read_image_from_url(url)) as f:
-        # TODO: Make my own color-grabber module. This is ugly as hell.
-        loop = asyncio.get_event_loop()
-        get_colour = functools.partial(ColorThief(f).get_color, quality=1)
-        return await loop.run_in_executor(None, get_colour)
+    data = await _read_image_from_url(url)
+    loop = asyncio.get_event_loop()
+    if numpy is None:
+        return await loop.run_in_executor(None, _colour_thief, data)
+    return await loop.run_in_executor(_get_pool(), _dominant_colour, data)
 
 
 async def url_color(url):
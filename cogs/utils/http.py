@@ -0,0 +1,92 @@
+import aiohttp
+import asyncio
+import json
+
+
+class ResponseTooLarge(aiohttp.ClientError):
+    """Exception raised when a response is bigger than what we're willing to read."""
+
+    def __init__(self, url, max_size):
+        super().__init__(f'{url} returned more than {max_size} bytes')
+        self.url = url
+        self.max_size = max_size
+
+
+class HTTPClient:
+    """The one HTTP client everything in the bot should go through.
+
+    It keeps a pool of connections around instead of opening a new one (and
+    doing the whole TLS handshake again) for every request, caps how many
+    requests can go to the same host at once, and puts a limit on how long
+    a request can take and how much of a response will be read.
+    """
+
+    def __init__(self, *, loop=None, limit=100, limit_per_host=8, timeout=30,
+                 max_size=8 * 1024 * 1024):
+        self.loop = loop or asyncio.get_event_loop()
+        self.max_size = max_size
+        connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host, loop=self.loop)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=timeout),
+            loop=self.loop,
+        )
+
+    @property
+    def closed(self):
+        return self.session.closed
+
+    async def close(self):
+        await self.session.close()
+
+    def request(self, method, url, **kwargs):
+        """Makes a request. This is the same as ClientSession.request.
+
+        Use this for things read() and json() don't cover, like streaming.
+        """
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    async def _read_body(self, resp, max_size):
+        if resp.content_length is not None and resp.content_length > max_size:
+            raise ResponseTooLarge(resp.url, max_size)
+
+        body = bytearray()
+        async for chunk in resp.content.iter_chunked(64 * 1024):
+            body += chunk
+            # Content-Length can lie, or not be there at all.
+            if len(body) > max_size:
+                raise ResponseTooLarge(resp.url, max_size)
+        return bytes(body)
+
+    async def read(self, url, *, method='GET', max_size=None, **kwargs):
+        """Returns the body of a response as bytes.
+
+        Raises ResponseTooLarge if the body is bigger than max_size bytes
+        (the client's max_size by default).
+        """
+        async with self.session.request(method, url, **kwargs) as resp:
+            resp.raise_for_status()
+            return await self._read_body(resp, max_size or self.max_size)
+
+    async def json(self, url, *, method='GET', max_size=None, **kwargs):
+        """Returns the body of a response as JSON.
+
+        Unlike ClientResponse.json, this doesn't care about the content type,
+        as some APIs don't bother setting it properly.
+        """
+        body = await self.read(url, method=method, max_size=max_size, **kwargs)
+        return json.loads(body.decode('utf-8'))
+
+
+_shared = None
+
+
+def shared_client(*, loop=None):
+    """Returns the HTTP client that's shared across the whole bot."""
+    global _shared
+    if _shared is None or _shared.closed:
+        _shared = HTTPClient(loop=loop)
+    return _shared
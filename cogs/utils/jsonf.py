@@ -3,13 +3,33 @@ import contextlib
 import collections
 import itertools
 import json
+import logging
 import os
 import uuid
+import weakref
+
+log = logging.getLogger(__name__)
 
 
 JSONS_PATH = 'jsonfiles/'
 os.makedirs(JSONS_PATH, exist_ok=True)
 
+# Every file whose writes might not be on disk yet, by name, so that
+# flush_all can write them out before the bot goes down.
+_write_behind = weakref.WeakValueDictionary()
+
+# What a removed key looks like to _changed.
+_DELETED = object()
+
+
+async def flush_all():
+    """Writes out every file's pending changes."""
+    for f in list(_write_behind.values()):
+        try:
+            await f.flush()
+        except Exception:
+            log.exception('Flushing %s failed.', f._name)
+
 
 # Shamelessly copied from Danny because he's Danny and he's cool.
 class JSONFile(collections.MutableMapping):
@@ -17,15 +37,43 @@ class JSONFile(collections.MutableMapping):
 
     Basically a wrapper for persistent data, whenever I don't want to use a DB,
     usually because it will get queried a ton (which is always pleasant).
+
+    By default every change rewrites the whole file. If flush_interval is
+    given, changes only mark the file as dirty, and it's written at most once
+    every flush_interval seconds instead. Use flush() to write it right away.
+
+    Passing engine='journal' gives a JournalFile instead, see that for details.
+
+    JSON only has string keys, so keys are turned into strings by default.
+    Passing key_type=int keeps them as ints in memory instead (they're only
+    strings in the file), which saves a str() on every lookup.
     """
     _transform_key = str
 
+    def __new__(cls, name, **options):
+        if cls is JSONFile:
+            journal = options.get('engine') == 'journal'
+            if options.get('key_type') is int:
+                cls = IntJournalFile if journal else IntJSONFile
+            elif journal:
+                cls = JournalFile
+        return super().__new__(cls)
+
     def __init__(self, name, **options):
         self._name = f'{JSONS_PATH}{name}'
         self._db = {}
 
         self._loop = options.pop('loop', asyncio.get_event_loop())
         self._lock = asyncio.Lock()
+        options.pop('engine', None)
+        options.pop('key_type', None)
+
+        self.flush_interval = options.pop('flush_interval', None)
+        self._dirty = False
+        self._flusher = None
+        if self.flush_interval is not None:
+            _write_behind[self._name] = self
+
         if options.pop('load_later', False):
             self._loop.create_task(self.load())
         else:
@@ -40,6 +88,14 @@ class JSONFile(collections.MutableMapping):
     def __delitem__(self, key):
         del self._db[self._transform_key(key)]
 
+    # These two are here because the ones from Mapping go through
+    # __getitem__ and catch the KeyError, which is slow for misses.
+    def __contains__(self, key):
+        return self._transform_key(key) in self._db
+
+    def get(self, key, default=None):
+        return self._db.get(self._transform_key(key), default)
+
     def __iter__(self):
         return iter(self._db)
 
@@ -48,35 +104,266 @@ class JSONFile(collections.MutableMapping):
 
     def load_from_file(self):
         with contextlib.suppress(FileNotFoundError), open(self._name, 'r') as f:
-            self._db.update(json.load(f))
+            data = json.load(f)
+            if self._transform_key is not str:
+                data = dict(self._convert_keys(data.items()))
+            self._db.update(data)
+
+    def _convert_keys(self, items):
+        for key, value in items:
+            try:
+                key = self._transform_key(key)
+            except (TypeError, ValueError):
+                # Files can have keys from before they had a key type, like
+                # slowmodes.json, which used to save some configs under the
+                # guild's name. There's no way to get the ID back from those.
+                log.warning('Dropping key %r from %s as it isn\'t a valid %s.',
+                            key, self._name, self._transform_key.__name__)
+            else:
+                yield key, value
 
     async def load(self):
         async with self._lock:
             await self._loop.run_in_executor(None, self.load_from_file)
 
-    def _dump(self):
+    def _dump(self, data):
         temp = f'{self._name}-{uuid.uuid4()}.tmp'
         with open(temp, 'w', encoding='utf-8') as tmp:
-            json.dump(self._db.copy(), tmp, ensure_ascii=True, separators=(',', ':'))
+            json.dump(data, tmp, ensure_ascii=True, separators=(',', ':'))
 
         # atomically move the file
         os.replace(temp, self._name)
 
     async def save(self):
         async with self._lock:
-            await self._loop.run_in_executor(None, self._dump)
+            # Anything that changes from here on needs another write.
+            self._dirty = False
+            # Copied here rather than in the executor, because the dict can't
+            # be changed while another thread is going through it.
+            await self._loop.run_in_executor(None, self._dump, self._db.copy())
+
+    async def flush(self):
+        """Writes out any pending changes right away."""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+
+        if self._dirty:
+            await self.save()
+        else:
+            # There might still be a write going on.
+            async with self._lock:
+                pass
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._flusher = None
+        try:
+            await self.save()
+        except Exception:
+            log.exception('Writing %s failed.', self._name)
+            self._mark_dirty()
+
+    def _mark_dirty(self):
+        self._dirty = True
+        if self._flusher is None:
+            self._flusher = self._loop.create_task(self._flush_later())
+
+    async def _changed(self, changes):
+        # changes is a dict of the keys that changed, with _DELETED for keys
+        # that were removed. Only the journal cares about them.
+        if self.flush_interval is None:
+            await self.save()
+        else:
+            self._mark_dirty()
 
     async def put(self, key, value, *args):
         """Edits a config entry."""
-        self._db[self._transform_key(key)] = value
-        await self.save()
+        key = self._transform_key(key)
+        self._db[key] = value
+        await self._changed({key: value})
 
     async def remove(self, key):
         """Removes a config entry."""
-        del self._db[self._transform_key(key)]
-        await self.save()
+        key = self._transform_key(key)
+        del self._db[key]
+        await self._changed({key: _DELETED})
+
+    async def update(self, mapping=(), **kwargs):
+        changes = {self._transform_key(k): v for k, v in dict(mapping, **kwargs).items()}
+        self._db.update(changes)
+        await self._changed(changes)
+
+
+class JournalFile(JSONFile):
+    """A JSONFile that appends changes to a journal instead of rewriting
+    the whole file every time.
+
+    Each change is one line of JSON at the end of ``<name>.journal``, either
+    ``[key, value]``, or ``[key]`` if the key was removed. Once
+    the journal gets bigger than compact_ratio times the last snapshot, the
+    whole thing gets written out as a new snapshot in the background, and
+    the journal starts over.
+
+    When compacting, the journal is first renamed to ``<name>.journal.old``
+    so that new changes can keep going to a fresh one. Loading replays the
+    snapshot, then the old journal, then the current one. Replaying the old
+    journal on top of a snapshot that already has it changes nothing, so a
+    crash at any point of the compaction is fine. A line that was cut off by
+    a crash is thrown out when it's loaded.
+    """
+
+    def __init__(self, name, **options):
+        self._journal_name = f'{JSONS_PATH}{name}.journal'
+        self._old_journal_name = f'{self._journal_name}.old'
+        self.compact_ratio = options.pop('compact_ratio', 2)
+        # So a tiny file isn't compacted every other change.
+        self.min_compact_size = options.pop('min_compact_size', 64 * 1024)
+
+        self._journal = None
+        self._journal_size = 0
+        self._snapshot_size = 0
+        self._compacting = None
+
+        options.pop('flush_interval', None)  # Every change is written right away.
+        super().__init__(name, **options)
+
+    # The journal is only ever opened in binary mode, so that the offsets
+    # and sizes are in bytes, no matter what newlines the platform uses.
+
+    def _replay(self, path):
+        try:
+            f = open(path, 'rb+')
+        except FileNotFoundError:
+            return 0
+
+        with f:
+            good = 0
+            for line in f:
+                try:
+                    # Every line is written with its newline last, so if
+                    # there's no newline, the line didn't get written fully.
+                    if not line.endswith(b'\n'):
+                        raise ValueError('no newline')
+                    key, *value = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    log.warning('%s is cut off at byte %d, throwing out the rest.', path, good)
+                    f.truncate(good)
+                    break
+
+                good += len(line)
+
+                # The journal might've been written with a different key type.
+                for key, _ in self._convert_keys([(key, None)]):
+                    if value:
+                        self._db[key] = value[0]
+                    else:
+                        self._db.pop(key, None)
+            return good
+
+    def load_from_file(self):
+        with contextlib.suppress(FileNotFoundError):
+            self._snapshot_size = os.path.getsize(self._name)
+        super().load_from_file()
+
+        had_old_journal = os.path.exists(self._old_journal_name)
+        self._replay(self._old_journal_name)
+        self._journal_size = self._replay(self._journal_name)
+
+        if had_old_journal:
+            # The last compaction didn't finish. It has to be finished now,
+            # otherwise the next one would overwrite the old journal.
+            self._snapshot_size = self._write_snapshot(self._db.copy())
+            open(self._journal_name, 'wb').close()
+            self._journal_size = 0
+
+        self._journal = open(self._journal_name, 'ab')
+
+    def _needs_compaction(self):
+        return self._journal_size > self.compact_ratio * max(self._snapshot_size, self.min_compact_size)
+
+    async def _changed(self, changes):
+        lines = b''.join(
+            json.dumps([key] if value is _DELETED else [key, value],
+                       ensure_ascii=True, separators=(',', ':')).encode('ascii') + b'\n'
+            for key, value in changes.items()
+        )
+
+        # A line or two is cheap enough to just write here. Flushing hands it
+        # over to the OS, so it's safe if the bot dies (but not the machine).
+        self._journal.write(lines)
+        self._journal.flush()
+        self._journal_size += len(lines)
+
+        if self._needs_compaction() and self._compacting is None:
+            self._compacting = self._loop.create_task(self._compact())
+
+    def _write_snapshot(self, data):
+        self._dump(data)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._old_journal_name)
+        return os.path.getsize(self._name)
+
+    def _retire_journal(self):
+        if not os.path.exists(self._old_journal_name):
+            os.replace(self._journal_name, self._old_journal_name)
+            return
+
+        # The last compaction failed, so the old journal is still needed.
+        with open(self._journal_name, 'rb') as current, \
+             open(self._old_journal_name, 'ab') as old:
+            old.write(current.read())
+        os.remove(self._journal_name)
+
+    async def _compact(self):
+        try:
+            await self.save()
+        except Exception:
+            log.exception('Compacting %s failed.', self._name)
+        finally:
+            self._compacting = None
+
+    async def save(self):
+        """Writes out a new snapshot and starts a new journal."""
+        async with self._lock:
+            # Everything up to here is about to be in the snapshot. Anything
+            # after this goes in the new journal.
+            self._journal.close()
+            self._retire_journal()
+            self._journal = open(self._journal_name, 'ab')
+            self._journal_size = 0
+
+            data = self._db.copy()
+            self._snapshot_size = await self._loop.run_in_executor(None, self._write_snapshot, data)
+
+    async def flush(self):
+        """Nothing is ever pending, this only waits for a compaction."""
+        async with self._lock:
+            pass
+
+
+class _IntKeys:
+    """Keeps the keys as ints in memory, since JSON can't.
+
+    json turns int keys into strings when it writes them, so they only have
+    to be turned back into ints when loading. The lookups don't transform
+    the key at all, so they must be given ints.
+    """
+    _transform_key = int
+
+    def __getitem__(self, key):
+        return self._db[key]
+
+    def __contains__(self, key):
+        return key in self._db
+
+    def get(self, key, default=None):
+        return self._db.get(key, default)
+
+
+class IntJSONFile(_IntKeys, JSONFile):
+    pass
 
-    async def update(self, mapping, **kwargs):
-        super().update(mapping, **kwargs)
-        await self.save()
 
+class IntJournalFile(_IntKeys, JournalFile):
+    pass
@@ -64,3 +64,18 @@ async def load_async(filename, loop=None):
             return json.load(f)
 
     return await loop.run_in_executor(None, nobody_kanna_cross_it)
+
+async def retry_forever(func, *, log, what, max_delay=300):
+    """Keeps awaiting func() until it works, waiting twice as long after
+    every failure (up to max_delay seconds). Returns what func returned.
+
+    This is for things that aren't urgent, but have to eventually work.
+    """
+    delay = 1
+    while True:
+        try:
+            return await func()
+        except Exception:
+            log.exception('%s failed, retrying in %d seconds.', what, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
@@ -2,12 +2,19 @@ import asyncio
 import collections
 import datetime
 import heapq
+import itertools
 import json
 import logging
+import math
 import time
 
 log = logging.getLogger(__name__)
 
+_missing = object()
+# The horizon before the first refill, when nothing is known about what's
+# in the database.
+_unknown = object()
+
 
 class _Entry(collections.namedtuple('_Entry', 'time event args kwargs created id')):
     __slots__ = ()
@@ -20,15 +27,15 @@ class _Entry(collections.namedtuple('_Entry', 'time event args kwargs created id
 
     @classmethod
     def from_record(cls, record):
-        """Returns a database from a record. This is purely internal."""
-        args_kwargs = json.loads(record.args_kwargs)
+        """Returns an entry from an asyncpg record. This is purely internal."""
+        args_kwargs = json.loads(record['args_kwargs'])
         return cls(
-            time=record.expires,
-            event=record.event,
+            time=record['expires'],
+            event=record['event'],
             args=args_kwargs['args'],
             kwargs=args_kwargs['kwargs'],
-            created=record.created,
-            id=record.id,
+            created=record['created'],
+            id=record['id'],
         )
 
     @property
@@ -51,10 +58,131 @@ class _Entry(collections.namedtuple('_Entry', 'time event args kwargs created id
         """Returns True if the event is "short".
 
         A short event gives an optimization opportunity, it doesn't have to be
-        sorted, in the queue or database. Instead, a Task can be created where
-        it sleeps for a period of time before being dispatched.
+        sorted, in the queue or database. Instead it goes in a timing wheel,
+        and is given a negative ID to tell it apart from the other entries.
         """
-        return self.seconds <= 30
+        return self.id is not None and self.id < 0
+
+
+class _TimingWheel:
+    """A hierarchical timing wheel.
+
+    Each level has ``slots`` slots, and each slot of a level spans as many
+    ticks as the entire level below it. Entries are put in the lowest level
+    that can hold them, and get moved down a level whenever the level below
+    comes around to them, until they end up in the bottom level and fire.
+
+    Adding and cancelling an entry are O(1), and the whole thing is driven
+    by a single loop.call_later per tick, which only runs while there's
+    something in the wheel. The defaults can hold a little over 7 hours.
+    """
+
+    def __init__(self, callback, *, loop, tick=0.1, slots=64, levels=3):
+        self._callback = callback
+        self._loop = loop
+        self._tick = tick
+        self._slots = slots
+        self._levels = [[{} for _ in range(slots)] for _ in range(levels)]
+        # id -> the slot the entry is currently in
+        self._where = {}
+        self._now = self._current_tick()
+        self._handle = None
+
+    def __len__(self):
+        return len(self._where)
+
+    def _current_tick(self):
+        return int(self._loop.time() / self._tick)
+
+    def _insert(self, id, tick, entry):
+        delta, index = tick - self._now, tick
+        slots = self._slots
+        for level in self._levels:
+            if delta < slots:
+                break
+            delta //= slots
+            index //= slots
+        # Entries too far out for the top level end up in it anyway. They'll
+        # just be put back whenever their slot comes around.
+        slot = level[index % slots]
+        slot[id] = (tick, entry)
+        self._where[id] = slot
+
+    def add(self, id, delay, entry):
+        """Fires the entry after delay seconds."""
+        if not self._where:
+            # Nothing's been ticking, so there's nothing to catch up on.
+            self._now = self._current_tick()
+
+        tick = max(self._current_tick() + math.ceil(delay / self._tick), self._now + 1)
+        self._insert(id, tick, entry)
+
+        if self._handle is None:
+            self._handle = self._loop.call_later(self._tick, self._on_tick)
+
+    def cancel(self, id):
+        """Cancels an entry. Returns True if it was actually in the wheel."""
+        slot = self._where.pop(id, None)
+        if slot is None:
+            return False
+
+        del slot[id]
+        if not self._where and self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        return True
+
+    def _advance(self):
+        now = self._now
+        slots = self._slots
+
+        # Bring down the entries of the upper levels whose time has come,
+        # starting from the highest one so they can trickle down.
+        for depth in reversed(range(1, len(self._levels))):
+            span = slots ** depth
+            if now % span:
+                continue
+
+            slot = self._levels[depth][(now // span) % slots]
+            moved = list(slot.items())
+            slot.clear()
+            for id, (tick, entry) in moved:
+                self._insert(id, tick, entry)
+
+        slot = self._levels[0][now % slots]
+        if not slot:
+            return
+
+        fired = list(slot.values())
+        for id in slot:
+            del self._where[id]
+        slot.clear()
+
+        for tick, entry in fired:
+            try:
+                self._callback(entry)
+            except Exception as e:
+                log.error('Dispatching %r from the timing wheel raised %r', entry, e)
+
+    def _on_tick(self):
+        self._handle = None
+        target = self._current_tick()
+        while self._now < target and self._where:
+            self._now += 1
+            self._advance()
+
+        if self._where:
+            self._handle = self._loop.call_later(self._tick, self._on_tick)
+
+    def clear(self):
+        for level in self._levels:
+            for slot in level:
+                slot.clear()
+        self._where.clear()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
 
 class BaseScheduler:
     """Manages timing related things.
@@ -80,6 +208,14 @@ class BaseScheduler:
         self._current = None
         self._runner = None
         self._callbacks = []
+        # Set whenever the runner has to look at the queue again, e.g. when
+        # something earlier than the current entry comes in. This is much
+        # cheaper than cancelling and recreating the runner every time.
+        self._wakeup = asyncio.Event()
+        # Short entries never touch the queue, they go in the wheel instead,
+        # and are given negative IDs so they can still be removed.
+        self._wheel = _TimingWheel(self._dispatch, loop=self._loop)
+        self._short_ids = itertools.count(-1, -1)
 
     def __del__(self):
         self.close()
@@ -94,56 +230,82 @@ class BaseScheduler:
         raise NotImplementedError
 
     async def _put(self, entry):
+        """Stores an entry. This must return the entry with its ID filled in."""
         raise NotImplementedError
 
     async def _remove(self, entry):
         raise NotImplementedError
 
+    def _requeue(self, entry):
+        """Puts back an entry that was taken by _get but not dispatched."""
+        raise NotImplementedError
+
+    def _pop_due(self, now):
+        """Takes every other entry that is due by now, so they can be
+        dispatched in one go. By default this doesn't take any.
+        """
+        return []
+
     async def _cleanup(self):
         pass
 
+    async def _sleep(self, delta):
+        """Sleeps for delta seconds. Returns False if woken up early."""
+        while delta > 0:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), min(self.MAX_SLEEP_TIME, delta))
+            except asyncio.TimeoutError:
+                delta -= self.MAX_SLEEP_TIME
+            else:
+                return False
+        return True
+
     async def _update(self):
         while True:
-            self._current = timer = await self._get()
+            timer = await self._get()
+            # There's no await between these two lines, so anything that
+            # comes in while we're sleeping is guaranteed to wake us up.
+            self._wakeup.clear()
+            self._current = timer
+
             now = self.time_function()
             delta = self._calculate_delta(timer.time, now)
             log.debug('sleeping for %s seconds', delta)
 
-            while delta > 0:
-                await asyncio.sleep(min(self.MAX_SLEEP_TIME, delta))
-                delta -= self.MAX_SLEEP_TIME
-
-            log.debug('entry %r is done, dispatching now.', timer)
-            self._dispatch(self._current)
+            if not await self._sleep(delta):
+                # Either something earlier came in, or the current entry was
+                # removed (in which case _current would've been cleared).
+                if self._current is timer:
+                    self._requeue(timer)
+                self._current = None
+                continue
 
-    def _restart(self):
-        self.stop()
-        self.run()
-
-    async def _short_task_optimization(self, delta, event):
-        # XXX: Is it a good idea to use self._loop.call_later? It's short enough,
-        #      and self._dispatch is not a coroutine.
-        await asyncio.sleep(delta)
-        self._dispatch(event)
+            self._current = None
+            batch = [timer, *self._pop_due(self.time_function())]
+            log.debug('%d entries are done, dispatching now.', len(batch))
+            for entry in batch:
+                self._dispatch(entry)
 
     async def add_abs(self, when, action, args=(), kwargs=None, id=None):
         """Enter a new event in the queue at an absolute time.
 
-        Returns an ID for the event which can be used to remove it,
-        if necessary.
+        Returns the entry, which can be used to remove it if necessary.
+        Short entries are kept in memory, so they won't survive a restart.
         """
 
         kwargs = kwargs or {}
-        event = _Entry(when, action, args, kwargs, None)
-        if event.short:
-            # Allow for short timer optimization
-            self._loop.create_task(self._short_task_optimization(event.seconds, event))
-            return
+        event = _Entry(when, action, args, kwargs, self.time_function())
+        if event.seconds <= self.SHORT_TASK_DURATION:
+            event = event._replace(id=next(self._short_ids))
+            self._wheel.add(event.id, event.seconds, event)
+            return event
 
-        await self._put(event)
+        event = await self._put(event)
 
         if self._current and event.time <= self._current.time:
-            self._restart()
+            self._wakeup.set()
+
+        return event
 
     async def add(self, delay, action, args=(), kwargs=None, id=None):
         """A variant that specifies the time as a relative time.
@@ -156,9 +318,15 @@ class BaseScheduler:
 
     async def remove(self, entry):
         """Removes an entry from the queue."""
+        if self._wheel.cancel(entry.id):
+            return
+
         await self._remove(entry)
 
-        self._restart()
+        current = self._current
+        if current is not None and current.id == entry.id:
+            self._current = None  # So the runner doesn't put it back.
+            self._wakeup.set()
 
     # Callback-related things
     def _dispatch(self, timer):
@@ -202,42 +370,110 @@ class BaseScheduler:
     def close(self):
         """Closes the running task, and does any cleanup, if necessary."""
         self.stop()
-        self.loop.create_task(self._cleanup())
+        self._loop.create_task(self._cleanup())
         del self._callbacks[:]
+        self._wheel.clear()
         self._current = None
 
 
 class QueueScheduler(BaseScheduler):
-    """Original implementation of a scheduler.
+    """An in-memory implementation of a scheduler.
+
+    All of the entries are stored in memory in a heap, which means they're
+    gone once the bot goes down. This is fine for ephemeral timers and for
+    testing, but anything that has to survive a restart should go in the
+    DatabaseScheduler instead.
 
-    This uses an asyncio.PriorityQueue, which means all of the events are stored
-    in memory. This can be very risky if too many entries are stored.
+    Removing an entry doesn't touch the heap. The entry is simply forgotten,
+    and skipped once it makes its way to the top of the heap.
     """
 
     def __init__(self, **kwargs):
-        super().__init(**kwargs)
-        self._pending = asyncio.PriorityQueue()
+        super().__init__(**kwargs)
+        # Heap of (time, id, entry)
+        self._queue = []
+        # id -> entry, for all the entries that haven't been dispatched or
+        # removed yet. Anything in the heap that isn't in here is dead.
+        self._entries = {}
+        self._ids = itertools.count(1)
+        self._have_data = asyncio.Event()
+        self.add_callback(self._sync_remove)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _sync_remove(self, entry):
+        self._entries.pop(entry.id, None)
 
-    # We have to override _restart as well because _get removes the entry.
-    def _restart(self):
-        if self._current is not None:
-            self._pending.put_nowait(self._current)
-        super()._restart()
+    def _pop_live(self):
+        queue, entries = self._queue, self._entries
+        while queue:
+            entry = heapq.heappop(queue)[-1]
+            if entry.id in entries:
+                return entry
+        return None
 
     async def _get(self):
-        return await self._pending.get()
+        while True:
+            entry = self._pop_live()
+            if entry is not None:
+                return entry
+
+            self._have_data.clear()
+            await self._have_data.wait()
+
+    def _pop_due(self, now):
+        queue, entries = self._queue, self._entries
+        due = []
+        while queue and queue[0][0] <= now:
+            entry = heapq.heappop(queue)[-1]
+            if entry.id in entries:
+                due.append(entry)
+        return due
+
+    def _requeue(self, entry):
+        heapq.heappush(self._queue, (entry.time, entry.id, entry))
 
     async def _put(self, entry):
-        self._pending.put_nowait(entry)
+        entry = entry._replace(id=next(self._ids))
+        self._entries[entry.id] = entry
+        self._requeue(entry)
+        self._have_data.set()
+        return entry
 
     async def _remove(self, entry):
-        # Don't remove the entry if it's the current one because _get will
-        # remove the entry from the queue.
-        if entry == self._current:
-            self._current = None  # Needed to tell _restart to not put the entry back in.
-        else:
-            self.pending._queue.remove(entry)
-            heapq.heapify(self.pending._queue)
+        self._entries.pop(entry.id, None)
+
+        # Don't let the dead entries pile up if a lot of them get removed.
+        if len(self._queue) > 2 * len(self._entries) + 64:
+            self._queue = [e for e in self._queue if e[1] in self._entries]
+            heapq.heapify(self._queue)
+
+    async def find(self, event, *args, limit=None, offset=0, **kwargs):
+        """Returns the pending entries of an event, ordered by when they expire.
+
+        This has the same semantics as DatabaseScheduler.find, it's just not
+        indexed.
+        """
+        num_args = len(args)
+        entries = sorted(
+            (e for e in self._entries.values()
+             if e.event == event
+             and tuple(e.args[:num_args]) == args
+             and all(e.kwargs.get(k, _missing) == v for k, v in kwargs.items())),
+            key=lambda e: (e.time, e.id)
+        )
+        end = None if limit is None else offset + limit
+        return entries[offset:end]
+
+    async def remove_where(self, event, *args, limit=None, **kwargs):
+        """Removes the pending entries of an event that match the given args
+        and kwargs, as in find(). Returns the entries that were removed.
+        """
+        entries = await self.find(event, *args, limit=limit, **kwargs)
+        for entry in entries:
+            await self.remove(entry)
+        return entries
 
 
 # Below here is the database form of the scheduler. If you want to just use the
@@ -259,82 +495,277 @@ class _Schedule(_Table, table_name='schedule'):
     created = asyncqlio.Column(asyncqlio.Timestamp)
     args_kwargs = asyncqlio.Column(dbtypes.JSON, default="'{}'::jsonb")
 
+# asyncqlio doesn't support expression indexes, so this has to be made manually.
+# Almost every lookup is by the event and the first one or two args (which are
+# usually IDs), so this covers all of them.
+_ARGS_INDEX_QUERY = """
+    CREATE INDEX IF NOT EXISTS schedule_event_args_idx
+    ON schedule (event, (args_kwargs #>> '{args,0}'), (args_kwargs #>> '{args,1}'));
+"""
+
+
+def _json_text(value):
+    # #>> returns strings as-is, but everything else as its JSON representation.
+    return value if isinstance(value, str) else json.dumps(value)
+
 
 class DatabaseScheduler(BaseScheduler):
     """An implementation of a Scheduler where a database is used.
 
     Only DBMSs that support JSON types are supported (so basically just PostgresSQL).
+
+    Rather than asking the database for the next entry every time one is
+    dispatched, the next ``window_size`` entries are kept in memory in a heap,
+    and the window is only refilled once it runs dry. Entries that are done
+    are deleted in bulk in the background.
     """
 
-    def __init__(self, db, *, safe_mode=True, **kwargs):
+    def __init__(self, db, *, window_size=256, **kwargs):
         super().__init__(**kwargs)
         self._db = db
         self._md = self._db.bind_tables(_Table)
-        self._safe = safe_mode
         self._have_data = asyncio.Event()
-        self._db_lock = asyncio.Event()
+
+        self.window_size = window_size
+        # Heap of (time, id, entry)
+        self._window = []
+        # The expiry of the last entry fetched into the window, if there are
+        # entries left in the database after it. None means that everything
+        # in the database is already in the window, and _unknown that there
+        # hasn't been a refill yet.
+        self._horizon = _unknown
+
+        # IDs of entries that are done (or removed), but haven't been deleted
+        # from the database yet. These must never be fetched again.
+        self._pending_deletes = set()
+        self._have_deletes = asyncio.Event()
+        self._deleter = None
+        # A refill that's in flight might have read entries before they were
+        # deleted, so entries deleted in the meantime are kept here until the
+        # refill is done, so it can throw them out.
+        self._refilling = False
+        self._deleted_while_refilling = set()
+        # Likewise, entries added during a refill might've been missed by it,
+        # so it decides whether they go in the window once it's done.
+        self._put_while_refilling = []
+
         self.add_callback(self._sync_remove)
 
     def _sync_remove(self, entry):
-        # Because we're scheduling a task rather than running the coroutine
-        # right away, there might be a slight race in that _update
-        # might grab the already done entry and dispatch it again.
-        # We need to make sure that doesn't happen. Which is why this
-        # asyncio.Event is here to keep it synchronized.
-        if getattr(entry, 'short', False):
-            # The entry was short, so there's no entry to remove in the database.
-            return 
-        self._db_lock.clear()
-        self._loop.create_task(self._remove(entry))
+        if entry.short:
+            # The entry lives in the wheel, so there's nothing in the database.
+            return
+        self._schedule_delete(entry.id)
+
+    def _schedule_delete(self, id):
+        self._pending_deletes.add(id)
+        self._have_deletes.set()
 
     # Overriding this because the two are datetime instances.
     @staticmethod
     def _calculate_delta(time1, time2):
         return (time1 - time2).total_seconds()
 
-    async def _get_entry(self):
-        await self._db_lock.wait()
+    async def create_indexes(self):
+        """Creates the indexes that find() and remove_where() rely on."""
+        async with self._db.get_session() as session:
+            await session.transaction.acquired_connection.execute(_ARGS_INDEX_QUERY)
+
+    async def find(self, event, *args, limit=None, offset=0, **kwargs):
+        """Returns the pending entries of an event, ordered by when they expire.
+
+        Only entries whose leading args match ``args``, and whose kwargs
+        match ``kwargs`` are returned. Lookups by the event and first two
+        args are indexed.
+        """
+        params = [event, list(self._pending_deletes)]
+        conditions = ['event = $1', 'NOT (id = ANY($2::int[]))']
+
+        for i, arg in enumerate(args):
+            params.append(_json_text(arg))
+            conditions.append(f"args_kwargs #>> '{{args,{i}}}' = ${len(params)}")
+
+        for key, value in kwargs.items():
+            # The key has to go in the path literal, it can't be a parameter.
+            if not key.isidentifier():
+                raise ValueError(f'{key!r} is not a valid kwarg name')
+            params.append(_json_text(value))
+            conditions.append(f"args_kwargs #>> '{{kwargs,{key}}}' = ${len(params)}")
+
+        params.append(offset)
+        query = (f"SELECT * FROM schedule WHERE {' AND '.join(conditions)} "
+                 f"ORDER BY expires OFFSET ${len(params)}")
+        if limit is not None:
+            params.append(limit)
+            query += f' LIMIT ${len(params)}'
+
+        # We have to go to the lowest level possible, because session.cursor
+        # uses str.format to format the parameters, which will throw a KeyError
+        # due to the {} in the JSON operators.
         async with self._db.get_session() as session:
-            query = session.select(_Schedule).order_by(_Schedule.expires).limit(1)
-            return await query.first()
+            records = await session.transaction.acquired_connection.fetch(query, *params)
+
+        return list(map(_Entry.from_record, records))
+
+    async def remove_where(self, event, *args, limit=None, **kwargs):
+        """Removes the pending entries of an event that match the given args
+        and kwargs, as in find(). Returns the entries that were removed.
+        """
+        entries = await self.find(event, *args, limit=limit, **kwargs)
+        for entry in entries:
+            await self.remove(entry)
+        return entries
+
+    async def _refill(self):
+        query = """SELECT *
+                   FROM schedule
+                   WHERE NOT (id = ANY($1::int[]))
+                   ORDER BY expires
+                   LIMIT $2;
+                """
+
+        self._refilling = True
+        try:
+            async with self._db.get_session() as session:
+                conn = session.transaction.acquired_connection
+                records = await conn.fetch(query, list(self._pending_deletes), self.window_size)
+        except BaseException:
+            # Nothing changed, so they go wherever they would've gone.
+            for entry in self._put_while_refilling:
+                if self._within_horizon(entry):
+                    self._push(entry)
+            raise
+        finally:
+            self._refilling = False
+            deleted, self._deleted_while_refilling = self._deleted_while_refilling, set()
+            added, self._put_while_refilling = self._put_while_refilling, []
+
+        # Entries might've been removed while we were waiting on the query
+        # (e.g. a reminder being cancelled), those must not come back.
+        removed = self._pending_deletes | deleted
+        fetched = map(_Entry.from_record, records)
+        entries = {e.id: e for e in itertools.chain(fetched, added) if e.id not in removed}
+        # Entries might've been requeued while we were waiting on the query,
+        # and some of those might be in the records as well.
+        entries.update((e[1], e[-1]) for e in self._window)
+
+        if len(records) == self.window_size:
+            # Anything after the last record is still in the database, and
+            # will be fetched in order by a later refill. Keeping it here
+            # would hold up everything in between until it's done.
+            self._horizon = horizon = records[-1]['expires']
+            values = [e for e in entries.values() if e.time <= horizon]
+        else:
+            self._horizon = None
+            values = entries.values()
+
+        window = [(e.time, e.id, e) for e in values]
+        heapq.heapify(window)
+        self._window = window
 
     async def _get(self):
         while True:
-            entry = await self._get_entry()  # Get the entry from the database
-            if entry is not None:
-                return _Entry.from_record(entry)
+            if not self._window:
+                await self._refill()
+
+            if self._window:
+                return heapq.heappop(self._window)[-1]
 
             self._have_data.clear()
             await self._have_data.wait()
 
+    def _within_horizon(self, entry):
+        # Entries past the horizon will get picked up by a later refill.
+        horizon = self._horizon
+        return horizon is None or horizon is not _unknown and entry.time <= horizon
+
+    def _push(self, entry):
+        window = self._window
+        # A refill that finished while the entry was being inserted might
+        # have fetched it already. The window is small, so this is cheap.
+        if any(e[1] == entry.id for e in window):
+            return
+
+        heapq.heappush(window, (entry.time, entry.id, entry))
+
+        # Don't let the window grow forever if a ton of entries are added
+        # while it holds everything. The rest will be fetched later.
+        if len(window) > self.window_size * 2:
+            self._window = window = heapq.nsmallest(self.window_size, window)
+            self._horizon = window[-1][0]
+
     async def _put(self, entry):
         # put the entry in the database
         # We have to use a manual query because of the JSON type.
         query = """INSERT INTO schedule (created, event, args_kwargs, expires)
                    VALUES ({t}, {ev}, {ex}::jsonb, {exp})
+                   RETURNING id;
                 """
         params = {'t': entry.created, 'ev': entry.event, 'exp': entry.time,
                   'ex': json.dumps({'args': entry.args, 'kwargs': entry.kwargs})}
 
         async with self._db.get_session() as session:
-            await session.execute(query, params)
+            cursor = await session.cursor(query, params)
+            row = await cursor.fetch_row()
+
+        entry = entry._replace(id=row['id'])
+        if self._refilling:
+            self._put_while_refilling.append(entry)
+        elif self._within_horizon(entry):
+            self._push(entry)
+
         self._have_data.set()
+        return entry
+
+    def _requeue(self, entry):
+        self._push(entry)
+
+    def _pop_due(self, now):
+        window = self._window
+        due = []
+        while window and window[0][0] <= now:
+            due.append(heapq.heappop(window)[-1])
+        return due
 
     async def _remove(self, entry):
-        # remove entry from the database
-        try:
-            async with self._db.get_session() as session:
-                await session.delete.table(_Schedule).where(_Schedule.id == entry.id)
-        except Exception as e:
-            # Something went terribly wrong with removing, so we gotta stop
-            # the scheduler, otherwise we'd run into an infinite loop.
-            if self._safe:
-                self.stop()
-            log.error('Removing %r failed. Exception: %r', entry, e)
-            raise
-        else:
-            self._db_lock.set()
+        window = [e for e in self._window if e[1] != entry.id]
+        if len(window) != len(self._window):
+            heapq.heapify(window)
+            self._window = window
+
+        self._schedule_delete(entry.id)
+
+    async def _delete_pending(self):
+        ids = list(self._pending_deletes)
+        if not ids:
+            return
+
+        async with self._db.get_session() as session:
+            await session.execute('DELETE FROM schedule WHERE id = ANY({ids}::int[]);', {'ids': ids})
+
+        # Only forget about them once they're really gone, otherwise a
+        # refill could fetch them again.
+        self._pending_deletes.difference_update(ids)
+        if self._refilling:
+            self._deleted_while_refilling.update(ids)
+
+    async def _run_deletes(self):
+        while True:
+            await self._have_deletes.wait()
+            self._have_deletes.clear()
+            try:
+                await self._delete_pending()
+            except Exception as e:
+                log.error('Removing %d entries failed. Exception: %r', len(self._pending_deletes), e)
+                await asyncio.sleep(5)
+                self._have_deletes.set()
+
+    async def _cleanup(self):
+        if self._deleter is not None:
+            self._deleter.cancel()
+        await self._delete_pending()
 
     def run(self):
-        self._db_lock.set()  # Set the event right away so we don't just wait.
+        if self._deleter is None or self._deleter.done():
+            self._deleter = self._loop.create_task(self._run_deletes())
         super().run()
@@ -1,4 +1,3 @@
-import aiohttp
 import asyncio
 import asyncqlio
 import collections
@@ -20,9 +19,9 @@ from more_itertools import always_iterable
 from . import context
 from .formatter import ChiakiFormatter
 
-from cogs.utils import errors
+from cogs.utils import colours, errors, http, jsonf
 from cogs.utils.jsonf import JSONFile
-from cogs.utils.misc import file_handler
+from cogs.utils.misc import file_handler, maybe_awaitable
 from cogs.utils.scheduler import DatabaseScheduler
 from cogs.utils.time import duration_units
 
@@ -80,13 +79,31 @@ del _make_permissions
 
 MAX_FORMATTER_WIDTH = 90
 
+
+class _PrefixMatcher:
+    """A compiled set of prefixes for a single guild (or DMs).
+
+    The custom prefixes are deduplicated and stored longest-first, followed
+    by the two mention forms, all in one tuple that's built only once. As
+    discord.py takes the first prefix that matches, a custom prefix always
+    wins over a shorter one that it starts with.
+    """
+    __slots__ = ('prefixes', )
+
+    def __init__(self, user_id, prefixes):
+        # sorted is stable, so prefixes of the same length keep their order.
+        custom = sorted(set(prefixes), key=len, reverse=True)
+        self.prefixes = (*custom, f'<@{user_id}> ', f'<@!{user_id}> ')
+
+
 def _callable_prefix(bot, message):
-    if message.guild:
-        prefixes = bot.custom_prefixes.get(message.guild.id, bot.default_prefix)
-    else:
-        prefixes = bot.default_prefix
+    guild_id = message.guild.id if message.guild else None
+    try:
+        matcher = bot._prefix_matchers[guild_id]
+    except KeyError:
+        matcher = bot._prefix_matchers[guild_id] = bot._compile_prefixes(guild_id)
 
-    return commands.when_mentioned_or(*prefixes)(bot, message)
+    return matcher.prefixes
 
 _chiaki_formatter = ChiakiFormatter(width=MAX_FORMATTER_WIDTH, show_check_failure=True)
 
@@ -99,7 +116,9 @@ class Chiaki(commands.Bot):
                          pm_help=None)
 
         # loop is needed to prevent outside coro errors
-        self.session = aiohttp.ClientSession(loop=self.loop)
+        self.http_client = http.shared_client(loop=self.loop)
+        # Kept around for anything that needs a raw ClientSession.
+        self.session = self.http_client.session
 
         try:
             with open('data/command_image_urls.json') as f:
@@ -109,15 +128,24 @@ class Chiaki(commands.Bot):
 
         self.message_counter = 0
         self.command_counter = collections.Counter()
-        self.custom_prefixes = JSONFile('customprefixes.json')
+        self.custom_prefixes = JSONFile('customprefixes.json', key_type=int)
+        self._prefix_matchers = {}
         self.cog_aliases = {}
 
+        self._command_gates = []
+        self.add_check(self._run_command_gates, call_once=True)
+
         self.reset_requested = False
 
         psql = f'postgresql://{config.psql_user}:{config.psql_pass}@{config.psql_host}/{config.psql_db}'
         self.db = asyncqlio.DatabaseInterface(psql)
         self.loop.run_until_complete(self._connect_to_db())
         self.db_scheduler = DatabaseScheduler(self.db, timefunc=datetime.utcnow)
+        try:
+            self.loop.run_until_complete(self.db_scheduler.create_indexes())
+        except Exception:
+            # The scheduler works without it, just slower.
+            log.exception('Creating the scheduler indexes failed.')
         self.db_scheduler.add_callback(self._dispatch_from_scheduler)
 
         for ext in config.extensions:
@@ -142,7 +170,21 @@ class Chiaki(commands.Bot):
         await self.db.connect()
 
     async def close(self):
-        await self.session.close()
+        # Give the cogs a chance to write out anything they've buffered
+        # before the HTTP session and the DB go away.
+        for cog in list(self.cogs.values()):
+            shutdown = getattr(cog, f'_{cog.__class__.__name__}__shutdown', None)
+            if shutdown is None:
+                continue
+
+            try:
+                await shutdown()
+            except Exception:
+                log.exception('Shutting down cog %r failed.', cog)
+
+        await jsonf.flush_all()
+        await colours.shutdown()
+        await self.http_client.close()
         await self.db.close()
         await super().close()
 
@@ -168,6 +210,32 @@ class Chiaki(commands.Bot):
         # remove cog aliases
         self.cog_aliases = {alias: real for alias, real in self.cog_aliases.items() if real is not cog}
 
+    def add_command_gate(self, gate, *, priority=0):
+        """Adds a stage to the command gate.
+
+        The gate is run once per invocation, before any other check. Its
+        stages are run from the lowest priority to the highest, and in the
+        order they were added if they have the same priority, so the order
+        doesn't depend on which extension was (re)loaded last. A stage can
+        either return False or raise a CheckFailure to stop the command.
+        The owner skips the gate entirely.
+        """
+        self._command_gates.append((priority, gate))
+        # sort is stable, so stages with the same priority keep their order.
+        self._command_gates.sort(key=lambda g: g[0])
+
+    def remove_command_gate(self, gate):
+        self._command_gates = [g for g in self._command_gates if g[1] != gate]
+
+    async def _run_command_gates(self, ctx):
+        if not self._command_gates or await self.is_owner(ctx.author):
+            return True
+
+        for _, gate in self._command_gates:
+            if not await maybe_awaitable(gate, ctx):
+                return False
+        return True
+
     @contextlib.contextmanager
     def temp_listener(self, func, name=None):
         """Context manager for temporary listeners"""
@@ -187,10 +255,17 @@ class Chiaki(commands.Bot):
     def run(self):
         super().run(config.token, reconnect=True)
 
+    def _compile_prefixes(self, guild_id):
+        if guild_id is None:
+            prefixes = self.default_prefix
+        else:
+            prefixes = self.custom_prefixes.get(guild_id, self.default_prefix)
+        return _PrefixMatcher(self.user.id, prefixes)
+
     def get_guild_prefixes(self, guild):
         proxy_msg = discord.Object(id=None)
         proxy_msg.guild = guild
-        return _callable_prefix(self, proxy_msg)
+        return list(_callable_prefix(self, proxy_msg))
 
     def get_raw_guild_prefixes(self, guild):
         return self.custom_prefixes.get(guild.id, self.default_prefix)
@@ -201,6 +276,8 @@ class Chiaki(commands.Bot):
             raise RuntimeError("You have too many prefixes you indecisive goof!")
 
         await self.custom_prefixes.put(guild.id, sorted(set(prefixes), reverse=True))
+        # Recompile the matcher the next time a message from this guild comes in.
+        self._prefix_matchers.pop(guild.id, None)
 
     async def process_commands(self, message):
         ctx = await self.get_context(message, cls=context.Context)
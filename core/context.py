@@ -5,10 +5,60 @@ import discord
 import random
 import sys
 
+from asyncqlio.orm.session import Session
 from discord.ext import commands
 from itertools import starmap
 
 
+class _LazySession(Session):
+    """A session that only checks out a connection the first time a query
+    actually runs.
+
+    Most commands never touch the database, so there's no point in holding
+    a connection from the pool for the entire invocation.
+    """
+
+    def __init__(self, ctx):
+        super().__init__(ctx.db)
+        self._ctx = ctx
+
+    @property
+    def started(self):
+        return self.transaction is not None
+
+    async def _ensure_started(self):
+        if self.transaction is not None:
+            return
+
+        await self.start()
+        self._ctx._on_session_start()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.transaction is None:
+            # Nothing was ever run, so there's nothing to commit or close.
+            return False
+        return await super().__aexit__(exc_type, exc, tb)
+
+    async def execute(self, sql, params=None):
+        await self._ensure_started()
+        return await super().execute(sql, params)
+
+    async def cursor(self, sql, params=None):
+        await self._ensure_started()
+        return await super().cursor(sql, params)
+
+    async def connection(self):
+        """Returns the underlying asyncpg connection, acquiring it if necessary.
+
+        Use this instead of ``session.transaction.acquired_connection``.
+        """
+        await self._ensure_started()
+        return self.transaction.acquired_connection
+
+
 class _ContextSession(collections.namedtuple('_ContextSession', 'ctx')):
     __slots__ = ()
 
@@ -26,6 +76,7 @@ class Context(commands.Context):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.session = None
+        self._used_db = False
 
     @property
     def clean_prefix(self):
@@ -40,12 +91,22 @@ class Context(commands.Context):
 
     async def _acquire(self):
         if self.session is None:
-            self.session = await self.db.get_session().__aenter__()
+            self.session = await _LazySession(self).__aenter__()
         return self.session
 
+    def _on_session_start(self):
+        # Only count each invocation once, even if the connection was
+        # released and re-acquired during an interactive command.
+        if not self._used_db:
+            self._used_db = True
+            self.bot.command_counter['used the database'] += 1
+
     def acquire(self):
         """Acquires a database session.
 
+        The session is lazy, no connection is checked out from the pool
+        until the first query is actually run.
+
         Can be used in an async context manager: ::
             async with ctx.acquire():
                 await ctx.db.execute(...)